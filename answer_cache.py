@@ -0,0 +1,162 @@
+import time
+import numpy as np
+from threading import Lock
+from collections import OrderedDict
+from constants import frequent_queries
+
+''' semantic cache of answers keyed on question embeddings '''
+
+
+class _Namespace:
+    """ Cached answers of one (model, embedding, safety mode) combination. """
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.matrix = None
+        self.matrix_ids = []
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, vector, question, response, expires_at):
+        self.entries[self.next_id] = (vector, question, response, expires_at)
+        self.next_id += 1
+        self.matrix = None
+
+    def remove(self, entry_id):
+        del self.entries[entry_id]
+        self.matrix = None
+
+    def search(self, vector):
+        # rebuilt lazily after adds/evictions, lookups are a single matrix-vector product
+        if self.matrix is None:
+            self.matrix_ids = list(self.entries)
+            self.matrix = np.vstack([self.entries[i][0] for i in self.matrix_ids]) if self.entries else None
+        if self.matrix is None:
+            return None, 0.0
+        scores = self.matrix @ vector
+        best = int(np.argmax(scores))
+        return self.matrix_ids[best], float(scores[best])
+
+
+class SemanticAnswerCache:
+    """
+    Return the cached answer of a near-duplicate question instead of calling the chain.
+
+    Questions are embedded with the embedding of the active chat and compared by cosine
+    similarity to earlier questions of the same namespace, a (model, embedding, safety mode)
+    tuple. A match at or above threshold is a hit. Entries expire after ttl seconds and each
+    namespace keeps at most max_entries, dropping the least recently used. With
+    seed_frequent_queries, seed() adds constants.frequent_queries, which never expire, to
+    namespaces ahead of time; the startup warm-up calls it so requests never pay for it.
+    """
+    def __init__(self, threshold=0.95, max_entries=500, ttl=24 * 60 * 60, seed_frequent_queries=False):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.seed_frequent_queries = seed_frequent_queries
+        self._lock = Lock()
+        self._namespaces = {}
+
+    def embed(self, lazy_embedding, question):
+        return _normalize(lazy_embedding.embedding.embed_query(question))
+
+    def lookup(self, namespace, vector):
+        """
+        Args:
+            namespace (tuple): The (model name, embedding name, safety mode) of the chat.
+            vector (np.ndarray): The normalized question embedding from embed().
+        Returns:
+            (dict | None): A response with "answer" and "source_documents", or None on a miss.
+        """
+        ns = self._get_namespace(namespace)
+        now = time.time()
+        with self._lock:
+            while True:
+                entry_id, score = ns.search(vector)
+                if entry_id is None or score < self.threshold:
+                    ns.misses += 1
+                    return None
+                _, _, response, expires_at = ns.entries[entry_id]
+                if expires_at is not None and expires_at < now:
+                    # lazily expire and look for the next best match
+                    ns.remove(entry_id)
+                    continue
+                ns.entries.move_to_end(entry_id)
+                ns.hits += 1
+                return response
+
+    def store(self, namespace, vector, question, response):
+        ns = self._get_namespace(namespace)
+        cached_response = {"answer": response["answer"], "source_documents": response.get("source_documents", [])}
+        with self._lock:
+            ns.add(vector, question, cached_response, time.time() + self.ttl)
+            while len(ns.entries) > self.max_entries:
+                oldest_id = next(iter(ns.entries))
+                ns.remove(oldest_id)
+
+    def seed(self, namespaces, lazy_embedding):
+        """
+        Add constants.frequent_queries to namespaces that all use lazy_embedding, embedding the
+        questions once. Does nothing unless seed_frequent_queries is set.
+
+        Args:
+            namespaces (list): The (model name, embedding name, safety mode) tuples to seed.
+            lazy_embedding (LazyEmbedding): The embedding of these namespaces.
+        """
+        if not self.seed_frequent_queries or not frequent_queries:
+            return
+        questions = list(frequent_queries)
+        vectors = [_normalize(vector) for vector in lazy_embedding.embedding.embed_documents(questions)]
+        for namespace in namespaces:
+            ns = self._get_namespace(namespace)
+            with self._lock:
+                for question, vector in zip(questions, vectors):
+                    ns.add(vector, question, {"answer": frequent_queries[question], "source_documents": []}, None)
+
+    def _get_namespace(self, namespace):
+        with self._lock:
+            ns = self._namespaces.get(namespace)
+            if ns is None:
+                ns = self._namespaces[namespace] = _Namespace()
+            return ns
+
+    def stats(self):
+        with self._lock:
+            namespaces = {}
+            for namespace, ns in self._namespaces.items():
+                lookups = ns.hits + ns.misses
+                namespaces["/".join(str(part) for part in namespace)] = {
+                    "entries": len(ns.entries),
+                    "hits": ns.hits,
+                    "misses": ns.misses,
+                    "hit_rate": ns.hits / lookups if lookups else 0.0,
+                }
+            hits = sum(ns["hits"] for ns in namespaces.values())
+            lookups = hits + sum(ns["misses"] for ns in namespaces.values())
+            return {"hits": hits, "lookups": lookups, "hit_rate": hits / lookups if lookups else 0.0,
+                    "namespaces": namespaces}
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+_answer_cache = None
+_answer_cache_lock = Lock()
+
+
+def get_answer_cache(config):
+    """ The process-wide answer cache, or None if answer_cache isn't enabled in config.yaml. """
+    global _answer_cache
+    cache_config = config.get('answer_cache') or {}
+    if not cache_config.get('enabled', False):
+        return None
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = SemanticAnswerCache(threshold=cache_config.get('threshold', 0.95),
+                                                max_entries=cache_config.get('max_entries', 500),
+                                                ttl=cache_config.get('ttl', 24 * 60 * 60),
+                                                seed_frequent_queries=cache_config.get('seed_frequent_queries', False))
+    return _answer_cache
@@ -0,0 +1,111 @@
+import json
+import time
+import itertools
+from threading import Lock, Thread
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+''' a local stand-in for the Slack Web API, for load tests '''
+
+BOT_USER_ID = "UBENCHBOT"
+
+
+class FakeSlack:
+    """
+    Answer the Web API methods the bot calls (auth.test, chat.postMessage, chat.update,
+    search.messages) after latency_ms, and keep count of the calls per method.
+    Every posted message gets a fresh ts and is kept so reactions can point at it.
+    Unknown methods answer {"ok": true}.
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self._lock = Lock()
+        self._ts = itertools.count(1)
+        self.calls = {}
+        self.posted = []
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = Thread(target=self._server.serve_forever, name="fake-slack", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def next_ts(self):
+        return f"{int(time.time())}.{next(self._ts):06d}"
+
+    def call(self, method, params):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method == "auth.test":
+            return {"ok": True, "user_id": BOT_USER_ID, "bot_id": "BBENCH", "team_id": "TBENCH",
+                    "user": "bench-bot", "team": "bench"}
+        if method == "chat.postMessage":
+            ts = self.next_ts()
+            with self._lock:
+                self.posted.append((params.get("channel"), ts))
+            return {"ok": True, "channel": params.get("channel"), "ts": ts,
+                    "message": {"text": params.get("text"), "ts": ts, "thread_ts": params.get("thread_ts")}}
+        if method == "chat.update":
+            return {"ok": True, "channel": params.get("channel"), "ts": params.get("ts"), "text": params.get("text")}
+        if method == "search.messages":
+            channel = params.get("query", "").rsplit("in:", 1)[-1]
+            return {"ok": True, "messages": {"matches": [{
+                "channel": {"id": "CBENCH", "name": channel},
+                "permalink": f"https://bench.slack.com/archives/CBENCH/p{i}",
+                "text": params.get("query", ""),
+                "ts": self.next_ts(),
+                "type": "message",
+            } for i in range(int(params.get("count", 5)))]}}
+        return {"ok": True}
+
+    def posted_messages(self):
+        with self._lock:
+            return list(self.posted)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.calls)
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or "{}")
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body).items()}
+                self._reply(fake.call(self.path.rsplit("/", 1)[-1], params))
+
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                params = {key: values[0] for key, values in parse_qs(query).items()}
+                self._reply(fake.call(path.rsplit("/", 1)[-1], params))
+
+            def _reply(self, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,80 @@
+import time
+import hashlib
+import numpy as np
+from typing import Any, List, Optional
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+''' deterministic stand-ins for the OpenAI models, with configurable latency '''
+
+VOCABULARY = ("the", "index", "slack", "thread", "answer", "model", "question", "document", "search", "user",
+              "channel", "token", "history", "cache", "query", "embedding", "result", "source", "message", "bot")
+
+
+def _seed(text):
+    return int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Unit vectors derived from a hash of the text, so the same text always gets the same vector.
+    Every call sleeps latency_ms, as one request to an embedding API would.
+    """
+    def __init__(self, dim=384, latency_ms=0):
+        self.dim = dim
+        self.latency = latency_ms / 1000
+
+    def _vector(self, text):
+        vector = np.random.default_rng(_seed(text)).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._vector(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model answering with answer_tokens words picked by a hash of the prompt, after
+    latency_ms. When streaming, the words are sent as tokens spread over that latency.
+    Reports token usage like ChatOpenAI, counting words.
+    """
+    latency_ms: float = 0
+    answer_tokens: int = 50
+    streaming: bool = False
+    model_name: str = "fake"
+    temperature: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs):
+        prompt = "\n".join(message.content for message in messages)
+        rng = np.random.default_rng(_seed(prompt))
+        words = [VOCABULARY[i] for i in rng.integers(len(VOCABULARY), size=self.answer_tokens)]
+        latency = self.latency_ms / 1000
+        if self.streaming and run_manager is not None:
+            for word in words:
+                time.sleep(latency / len(words))
+                run_manager.on_llm_new_token(word + " ")
+        else:
+            time.sleep(latency)
+        text = " ".join(words)
+        token_usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": len(words)}
+        token_usage["total_tokens"] = token_usage["prompt_tokens"] + token_usage["completion_tokens"]
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))],
+                          llm_output={"token_usage": token_usage, "model_name": self.model_name})
+
+
+class WhitespaceTokenizer:
+    """ Counts words instead of GPT-2 tokens, so history trimming runs without downloading a tokenizer. """
+    def encode(self, text):
+        return text.split()
@@ -0,0 +1,467 @@
+import os
+import sys
+import json
+import hmac
+import time
+import yaml
+import random
+import shutil
+import hashlib
+import logging
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+import urllib.request
+from threading import Lock, Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings, WhitespaceTokenizer, VOCABULARY
+from benchmarks.fake_slack import FakeSlack, BOT_USER_ID
+
+'''
+replay app_mention and reaction_added events against the bot's /slack/events route, with a
+local fake of the Slack Web API and deterministic fakes of the OpenAI models, and report
+throughput, latency percentiles, memory growth and sqlite write rates
+
+usage (from the repository root):
+    python -m benchmarks.load_test --requests 500 --concurrency 16
+    python -m benchmarks.load_test --payloads recorded_events.jsonl --concurrency 8 --llm-latency-ms 1500
+    python -m benchmarks.load_test --output run.json --baseline last_release.json --max-regression 0.2
+'''
+
+logger = logging.getLogger(__name__)
+
+SIGNING_SECRET = "bench-signing-secret"
+
+
+def rss_bytes():
+    """ Resident set size of this process (linux), falling back to the peak RSS elsewhere. """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def build_workdir(args, fake_slack_url):
+    """
+    Copy config.yaml into a scratch directory and point it at synthetic FAISS indexes built
+    there with FakeEmbeddings, so the bot's databases and logs stay out of the repository.
+    """
+    from langchain.vectorstores import FAISS
+    workdir = args.workdir or tempfile.mkdtemp(prefix='slackbot-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    with open(os.path.join(REPO_ROOT, args.config)) as f:
+        config = yaml.safe_load(f)
+
+    rng = random.Random(args.seed)
+    texts = [" ".join(rng.choice(VOCABULARY) for _ in range(80)) for _ in range(args.docs)]
+    metadatas = [{"source": f"bench-doc-{i}"} for i in range(args.docs)]
+    embeddings = FakeEmbeddings(dim=args.dim)
+    for vb_config in config.get('vectordb', []):
+        vb_config['path'] = os.path.join(workdir, 'indexes', vb_config['vb_name'])
+        # the benchmark measures loading and searching, not training, so always build a flat index
+        vb_config['index'] = {'type': 'Flat'}
+        if not os.path.exists(os.path.join(vb_config['path'], 'index.faiss')):
+            FAISS.from_texts(texts, embeddings, metadatas=metadatas).save_local(vb_config['path'])
+
+    config['tracing'] = {'log': True}
+    with open(os.path.join(workdir, 'config.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+
+    os.environ.update(SLACK_BOT_TOKEN="xoxb-bench", SLACK_USER_TOKEN="xoxp-bench",
+                      SLACK_SIGNING_SECRET=SIGNING_SECRET, SLACK_API_URL=fake_slack_url,
+                      OPENAI_API_KEY="sk-bench")
+    return workdir
+
+
+def install_fakes(args):
+    """ Swap the OpenAI models, local embeddings and the GPT-2 tokenizer for the deterministic fakes. """
+    import lazy_model
+    def load_model(self, **overrides):
+        return FakeChatModel(latency_ms=args.llm_latency_ms, answer_tokens=args.answer_tokens,
+                             streaming=overrides.get('streaming', bool(self.config.get('streaming'))))
+    def load_embedding(self):
+        return FakeEmbeddings(dim=args.dim, latency_ms=args.embedding_latency_ms)
+    lazy_model.LazyModel._load_model = load_model
+    lazy_model.LazyEmbedding._load_embedding = load_embedding
+    lazy_model.get_tokenizer = lambda name: WhitespaceTokenizer()
+
+
+class TraceCollector(logging.Handler):
+    """ Keep the JSON trace the bot logs when it finishes a mention, with the time it arrived. """
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self._lock = Lock()
+        self.traces = {}
+
+    def emit(self, record):
+        finished_at = time.perf_counter()
+        try:
+            trace = json.loads(record.getMessage())
+        except ValueError:
+            return
+        with self._lock:
+            self.traces[trace['request_id']] = (finished_at, trace)
+
+    def get(self, request_id):
+        with self._lock:
+            return self.traces.get(request_id)
+
+
+def envelope(event, event_id):
+    return {"token": "bench", "team_id": "TBENCH", "api_app_id": "ABENCH", "type": "event_callback",
+            "event_id": event_id, "event_time": int(time.time()), "event": event}
+
+
+class SyntheticEvents:
+    """
+    Mentions by random users with questions drawn from a pool of distinct_questions (so some
+    repeat and hit the answer cache), followup_ratio of them in one of the user's earlier
+    threads, and reaction_ratio thumbs up/down on replies the bot has posted.
+    """
+    def __init__(self, fake_slack, users=50, distinct_questions=200, followup_ratio=0.3, reaction_ratio=0.1, seed=0):
+        self.fake_slack = fake_slack
+        self.users = users
+        self.followup_ratio = followup_ratio
+        self.reaction_ratio = reaction_ratio
+        self.rng = random.Random(seed)
+        self.questions = [" ".join(self.rng.choice(VOCABULARY) for _ in range(12)) + "?"
+                          for _ in range(distinct_questions)]
+        self.threads = {}
+        self._lock = Lock()
+
+    def next(self, i):
+        with self._lock:
+            posted = self.fake_slack.posted_messages()
+            event_id = f"EvBENCH{i:08d}"
+            user = f"UBENCH{self.rng.randrange(self.users)}"
+            if posted and self.rng.random() < self.reaction_ratio:
+                channel, ts = self.rng.choice(posted)
+                return envelope({"type": "reaction_added", "user": user, "reaction": self.rng.choice(["+1", "-1"]),
+                                 "item": {"type": "message", "channel": channel, "ts": ts},
+                                 "event_ts": self.fake_slack.next_ts()}, event_id)
+            ts = self.fake_slack.next_ts()
+            event = {"type": "app_mention", "user": user, "channel": "CBENCH", "ts": ts, "event_ts": ts,
+                     "text": f"<@{BOT_USER_ID}> {self.rng.choice(self.questions)}"}
+            threads = self.threads.setdefault(user, [])
+            if threads and self.rng.random() < self.followup_ratio:
+                event["thread_ts"] = self.rng.choice(threads)
+            else:
+                threads.append(ts)
+            return envelope(event, event_id)
+
+
+class RecordedEvents:
+    """ Event payloads from a JSONL file, replayed in order and from the start again when exhausted. """
+    def __init__(self, path):
+        with open(path, encoding='utf-8') as f:
+            self.payloads = [json.loads(line) for line in f if line.strip()]
+        if not self.payloads:
+            raise ValueError(f"No payloads in {path}")
+
+    def next(self, i):
+        body = json.loads(json.dumps(self.payloads[i % len(self.payloads)]))
+        # every replay is a new delivery, otherwise the mention queue drops it as a retry
+        body["event_id"] = f"{body.get('event_id', 'Ev')}-{i}"
+        return body
+
+
+def post_event(url, body):
+    data = json.dumps(body).encode('utf-8')
+    timestamp = str(int(time.time()))
+    signature = "v0=" + hmac.new(SIGNING_SECRET.encode('utf-8'), f"v0:{timestamp}:".encode('utf-8') + data,
+                                 hashlib.sha256).hexdigest()
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json",
+                                                              "X-Slack-Request-Timestamp": timestamp,
+                                                              "X-Slack-Signature": signature})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+        return response.status
+
+
+class MemorySampler:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.peak = rss_bytes()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="memory-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+
+def percentile(values, q):
+    # kept here rather than imported from data_process, which would import the bot before its import is timed
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+            "max": max(values)}
+
+
+def count_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in ('turns', 'reactions')}
+    finally:
+        conn.close()
+
+
+def turned_away(bot, queue_before):
+    # mentions the queue rejected or dropped as retries never produce a trace
+    queue_stats = bot.mention_dispatcher.stats()
+    return (queue_stats['rejected'] - queue_before['rejected']) + (queue_stats['duplicates'] - queue_before['duplicates'])
+
+
+def run(args):
+    fake_slack = FakeSlack(latency_ms=args.slack_latency_ms).start()
+    workdir = build_workdir(args, fake_slack.url)
+    install_fakes(args)
+    collector = TraceCollector()
+    trace_logger = logging.getLogger('trace')
+    trace_logger.addHandler(collector)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+    # the bot reads config.yaml and writes its databases and log relative to the working directory
+    os.chdir(workdir)
+    start = time.perf_counter()
+    from main import create_app
+    import_seconds = time.perf_counter() - start
+    flask_app = create_app()
+    from setup_app import get_bot
+    from slack_db import DB_PATH
+    bot = get_bot()
+    logging.getLogger().setLevel(args.log_level)
+    while not bot.warmup.is_ready() and bot.warmup.status != "failed":
+        time.sleep(0.05)
+    ready_seconds = time.perf_counter() - start
+
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+    Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/slack/events"
+
+    source = RecordedEvents(args.payloads) if args.payloads else SyntheticEvents(
+        fake_slack, users=args.users, distinct_questions=args.distinct_questions,
+        followup_ratio=args.followup_ratio, reaction_ratio=args.reaction_ratio, seed=args.seed)
+    db_path = os.path.join(workdir, DB_PATH)
+    rows_before = count_rows(db_path)
+    queue_before = bot.mention_dispatcher.stats()
+    if args.tracemalloc:
+        tracemalloc.start()
+        snapshot_before = tracemalloc.take_snapshot()
+    rss_start = rss_bytes()
+    sampler = MemorySampler().start()
+
+    sent = []
+    sent_lock = Lock()
+    def send(i):
+        body = source.next(i)
+        sent_at = time.perf_counter()
+        try:
+            status = post_event(url, body)
+        except Exception as e:
+            logger.warning(f"Posting {body.get('event_id')} failed: {e}")
+            status = None
+        with sent_lock:
+            sent.append((body["event"]["type"], body.get("event_id"), sent_at, time.perf_counter() - sent_at, status))
+
+    run_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(send, range(args.requests)))
+    send_seconds = time.perf_counter() - run_start
+
+    # mentions are answered after the ack, wait until each one finished or was turned away
+    mentions = [row for row in sent if row[0] == "app_mention" and row[4] == 200]
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline:
+        if sum(collector.get(row[1]) is not None for row in mentions) + turned_away(bot, queue_before) >= len(mentions):
+            break
+        time.sleep(0.05)
+    wall_seconds = time.perf_counter() - run_start
+    while bot.interaction_logger.stats()['queue_depth'] and time.monotonic() < deadline:
+        time.sleep(0.05)
+    time.sleep(bot.interaction_logger.flush_interval)
+    sampler.stop()
+    rss_end = rss_bytes()
+    rows_after = count_rows(db_path)
+
+    end_to_end = []
+    stages = {}
+    errors = 0
+    for _, event_id, sent_at, _, _ in mentions:
+        finished = collector.get(event_id)
+        if finished is None:
+            continue
+        finished_at, trace = finished
+        end_to_end.append((finished_at - sent_at) * 1000)
+        errors += trace['status'] != 'ok'
+        for stage, ms in trace['stages_ms'].items():
+            stages.setdefault(stage, []).append(ms)
+    completed = len(end_to_end)
+    logger_stats = bot.interaction_logger.stats()
+    rows_written = sum(rows_after.values()) - sum(rows_before.values())
+    queue_stats = bot.mention_dispatcher.stats()
+
+    report = {
+        "requests": len(sent),
+        "mentions": sum(row[0] == "app_mention" for row in sent),
+        "reactions": sum(row[0] == "reaction_added" for row in sent),
+        "concurrency": args.concurrency,
+        "startup": {"import_seconds": import_seconds, "ready_seconds": ready_seconds},
+        "send_seconds": send_seconds,
+        "wall_seconds": wall_seconds,
+        "ack_rps": len(sent) / send_seconds if send_seconds else 0.0,
+        "throughput_rps": completed / wall_seconds if wall_seconds else 0.0,
+        "completed": completed,
+        "errors": errors,
+        "http_failures": sum(row[4] != 200 for row in sent),
+        "rejected": queue_stats['rejected'] - queue_before['rejected'],
+        "timed_out": len(mentions) - completed - turned_away(bot, queue_before),
+        "ack_ms": summarize([row[3] * 1000 for row in sent]),
+        "end_to_end_ms": summarize(end_to_end),
+        "stages_ms": {stage: summarize(values) for stage, values in sorted(stages.items())},
+        "memory": {
+            "rss_start_mb": rss_start / 2 ** 20,
+            "rss_end_mb": rss_end / 2 ** 20,
+            "rss_peak_mb": sampler.peak / 2 ** 20,
+            "growth_mb": (rss_end - rss_start) / 2 ** 20,
+            "growth_kb_per_mention": (rss_end - rss_start) / 1024 / completed if completed else 0.0,
+        },
+        "sqlite": {
+            "rows_written": rows_written,
+            "rows_per_second": rows_written / wall_seconds if wall_seconds else 0.0,
+            "batches": logger_stats['batches'],
+            "avg_flush_ms": logger_stats['avg_flush_seconds'] * 1000,
+            "max_flush_ms": logger_stats['max_flush_seconds'] * 1000,
+            "failed_rows": logger_stats['failed_rows'],
+        },
+        "chat_state": bot.chat_state_store.stats(),
+        "slack_calls": fake_slack.stats(),
+    }
+    if args.tracemalloc:
+        top = tracemalloc.take_snapshot().compare_to(snapshot_before, 'lineno')[:10]
+        report["memory"]["top_growth"] = [{"site": str(stat.traceback), "kb": stat.size_diff / 1024} for stat in top]
+        tracemalloc.stop()
+
+    server.shutdown()
+    fake_slack.stop()
+    if not args.keep_workdir and not args.workdir:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def compare(report, baseline, tolerance):
+    """
+    Regressions against an earlier report: end-to-end p95, per mention memory growth and
+    throughput or sqlite write rate worse by more than tolerance (a fraction).
+    """
+    checks = [
+        ("end_to_end_ms.p95", lambda r: r["end_to_end_ms"].get("p95"), True),
+        ("memory.growth_kb_per_mention", lambda r: r["memory"]["growth_kb_per_mention"], True),
+        ("throughput_rps", lambda r: r["throughput_rps"], False),
+        ("sqlite.rows_per_second", lambda r: r["sqlite"]["rows_per_second"], False),
+    ]
+    regressions = []
+    for name, value, higher_is_worse in checks:
+        current, previous = value(report), value(baseline)
+        if not current or not previous:
+            continue
+        change = (current - previous) / abs(previous)
+        if (change if higher_is_worse else -change) > tolerance:
+            regressions.append(f"{name}: {previous:.2f} -> {current:.2f} ({change:+.0%})")
+    return regressions
+
+
+def print_report(report):
+    print(f"requests: {report['requests']} ({report['mentions']} mentions, {report['reactions']} reactions) "
+          f"at concurrency {report['concurrency']}")
+    print(f"startup: import {report['startup']['import_seconds']:.2f}s, ready {report['startup']['ready_seconds']:.2f}s")
+    print(f"throughput: {report['throughput_rps']:.2f} mentions/s answered, {report['ack_rps']:.1f} events/s acked")
+    print(f"completed: {report['completed']}, errors: {report['errors']}, rejected: {report['rejected']}, "
+          f"timed out: {report['timed_out']}, http failures: {report['http_failures']}")
+    for name in ("ack_ms", "end_to_end_ms"):
+        values = report[name]
+        if values:
+            print(f"{name}: p50 {values['p50']:.1f}  p95 {values['p95']:.1f}  p99 {values['p99']:.1f}  max {values['max']:.1f}")
+    for stage, values in report["stages_ms"].items():
+        print(f"  {stage:<22} p50 {values['p50']:8.1f}  p95 {values['p95']:8.1f}  p99 {values['p99']:8.1f}")
+    memory = report["memory"]
+    print(f"memory: rss {memory['rss_start_mb']:.1f} -> {memory['rss_end_mb']:.1f} MB (peak {memory['rss_peak_mb']:.1f}), "
+          f"{memory['growth_kb_per_mention']:.1f} KB per mention")
+    sqlite_stats = report["sqlite"]
+    print(f"sqlite: {sqlite_stats['rows_written']} rows, {sqlite_stats['rows_per_second']:.1f} rows/s in "
+          f"{sqlite_stats['batches']} batches, flush avg {sqlite_stats['avg_flush_ms']:.2f} ms "
+          f"max {sqlite_stats['max_flush_ms']:.2f} ms")
+    print(f"slack calls: {report['slack_calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot's /slack/events route with fake Slack and OpenAI backends.")
+    parser.add_argument('--config', default='config.yaml', help="bot config to start from, relative to the repository root")
+    parser.add_argument('--requests', type=int, default=200, help="number of events to send")
+    parser.add_argument('--concurrency', type=int, default=8, help="events sent at the same time")
+    parser.add_argument('--payloads', help="JSONL file of recorded Events API bodies to replay instead of synthetic events")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--distinct-questions', type=int, default=200)
+    parser.add_argument('--followup-ratio', type=float, default=0.3)
+    parser.add_argument('--reaction-ratio', type=float, default=0.1)
+    parser.add_argument('--llm-latency-ms', type=float, default=500)
+    parser.add_argument('--answer-tokens', type=int, default=50)
+    parser.add_argument('--embedding-latency-ms', type=float, default=20)
+    parser.add_argument('--slack-latency-ms', type=float, default=20)
+    parser.add_argument('--docs', type=int, default=5000, help="documents in the synthetic indexes")
+    parser.add_argument('--dim', type=int, default=384, help="dimension of the fake embeddings")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drain-timeout', type=float, default=300, help="seconds to wait for queued mentions")
+    parser.add_argument('--workdir', help="reuse this directory (and its indexes) instead of a temporary one")
+    parser.add_argument('--keep-workdir', action='store_true')
+    parser.add_argument('--tracemalloc', action='store_true', help="report the allocation sites that grew the most")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help="write the report as JSON")
+    parser.add_argument('--baseline', help="earlier JSON report to compare against")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="fail when a metric is worse than the baseline by more than this fraction")
+    args = parser.parse_args()
+    # the run changes into the scratch directory, resolve paths given on the command line first
+    for name in ('payloads', 'workdir', 'output', 'baseline'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
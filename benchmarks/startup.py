@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from statistics import median
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# only the standard library is imported up here, the child measures the bot's imports from scratch
+from benchmarks.fake_slack import FakeSlack
+
+'''
+measure how long the bot takes to import, to build its app and to become ready (warm-up done),
+each trial in a fresh interpreter, plus the slowest imports of `import main` from -X importtime
+
+usage (from the repository root):
+    python -m benchmarks.startup --trials 5
+    python -m benchmarks.startup --trials 10 --docs 50000 --output startup.json
+'''
+
+
+def child(args):
+    """ One cold start, run in its own interpreter. Prints its timings as JSON on the last line. """
+    fake_slack = FakeSlack().start()
+    os.environ["SLACK_API_URL"] = fake_slack.url
+    os.chdir(args.workdir)
+    start = time.perf_counter()
+    from main import create_app
+    import_seconds = time.perf_counter() - start
+
+    # the fakes import langchain, time them apart so create_app and the warm-up are measured without it
+    fakes_start = time.perf_counter()
+    from benchmarks.load_test import install_fakes
+    install_fakes(args)
+    fakes_seconds = time.perf_counter() - fakes_start
+
+    create_start = time.perf_counter()
+    flask_app = create_app()
+    create_app_seconds = time.perf_counter() - create_start
+    from setup_app import get_bot
+    client = flask_app.test_client()
+    while client.get("/healthz").status_code != 200:
+        if get_bot().warmup.status == "failed":
+            break
+        time.sleep(0.01)
+    ready_seconds = time.perf_counter() - create_start
+    print(json.dumps({"import_seconds": import_seconds, "fakes_seconds": fakes_seconds,
+                      "create_app_seconds": create_app_seconds, "ready_seconds": ready_seconds,
+                      "warmup": get_bot().warmup.health(), "slack_calls": fake_slack.stats()}))
+    sys.stdout.flush()
+    # skip interpreter teardown, it isn't part of startup
+    os._exit(0)
+
+
+def run_trial(args):
+    command = [sys.executable, "-m", "benchmarks.startup", "--child", "--workdir", args.workdir, "--dim", str(args.dim)]
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True)
+    wall_seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"Startup trial failed:\n{result.stderr[-2000:]}")
+    trial = json.loads(result.stdout.strip().splitlines()[-1])
+    # from process start, including the interpreter itself and the exit
+    trial["process_seconds"] = wall_seconds
+    return trial
+
+
+def import_times(top):
+    """ The slowest top-level imports of `import main`, from python -X importtime. """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=REPO_ROOT,
+                            capture_output=True, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented, only keep what main and its direct imports pull in
+        if len(name) - len(name.lstrip()) <= 3:
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(modules, key=lambda module: module[1], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the bot's import time and time to ready.")
+    parser.add_argument('--config', default='config.yaml', help="bot config to start from, relative to the repository root")
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--docs', type=int, default=5000, help="documents in the synthetic indexes")
+    parser.add_argument('--dim', type=int, default=384, help="dimension of the fake embeddings")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="reuse this directory (and its indexes) instead of a temporary one")
+    parser.add_argument('--top', type=int, default=15, help="number of slowest imports to list")
+    parser.add_argument('--output', help="write the report as JSON")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--llm-latency-ms', type=float, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--embedding-latency-ms', type=float, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--answer-tokens', type=int, default=50, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    from benchmarks.load_test import build_workdir
+    if args.workdir:
+        args.workdir = os.path.abspath(args.workdir)
+    # the children start their own fake slack, this url is only a placeholder for the environment
+    args.workdir = build_workdir(args, "http://127.0.0.1:9/api/")
+
+    trials = [run_trial(args) for _ in range(args.trials)]
+    report = {"trials": args.trials}
+    for name in ("process_seconds", "import_seconds", "fakes_seconds", "create_app_seconds", "ready_seconds"):
+        values = [trial[name] for trial in trials]
+        report[name] = {"median": median(values), "min": min(values), "max": max(values)}
+    report["warmup"] = trials[-1]["warmup"]
+    report["slack_calls"] = trials[-1]["slack_calls"]
+    report["slowest_imports"] = import_times(args.top)
+
+    for name in ("process_seconds", "import_seconds", "fakes_seconds", "create_app_seconds", "ready_seconds"):
+        values = report[name]
+        print(f"{name:<20} median {values['median']:.3f}s  min {values['min']:.3f}s  max {values['max']:.3f}s")
+    print(f"warm-up: {report['warmup']}")
+    print("slowest imports of `import main` (cumulative):")
+    for module, seconds in report["slowest_imports"]:
+        print(f"  {seconds:8.3f}s  {module}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
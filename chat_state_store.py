@@ -0,0 +1,359 @@
+import json
+import time
+import zlib
+import sqlite3
+import logging
+from threading import Lock, Thread, Event, local
+from collections import OrderedDict
+from contextlib import contextmanager
+from constants import CHAT_STATE_TIMEOUT
+from history import ThreadHistory
+
+''' per user chat state and the stores keeping it, in process or shared between worker processes '''
+
+logger = logging.getLogger(__name__)
+
+# rough size of a ChatState without its thread histories, used for memory estimates
+CHAT_STATE_OVERHEAD_BYTES = 500
+
+
+class ChatState:
+    __slots__ = ('safety_mode', 'thread_histories', 'last_active', 'model_name', 'embedding_name')
+
+    def __init__(self):
+        self.safety_mode = False
+        self.thread_histories = {}
+        self.last_active = time.time()
+        self.model_name = None
+        self.embedding_name = None
+
+    def set_safety_mode(self, mode):
+        self.safety_mode = mode
+
+    def get_safety_mode(self):
+        return self.safety_mode
+
+    def get_thread_history(self, thread_id):
+        if thread_id not in self.thread_histories:
+            self.thread_histories[thread_id] = ThreadHistory()
+        return self.thread_histories[thread_id]
+
+    def set_thread_history(self, thread_id, history):
+        self.thread_histories[thread_id] = history
+
+    def set_model_and_embedding(self, model_name, embedding_name):
+        self.model_name = model_name
+        self.embedding_name = embedding_name
+
+    def reset_chatbot(self):
+        # the next mention picks the model and embedding again
+        self.model_name = None
+        self.embedding_name = None
+
+    def update_last_active(self):
+        self.last_active = time.time()
+
+    def to_dict(self):
+        return {
+            "safety_mode": self.safety_mode,
+            "last_active": self.last_active,
+            "model_name": self.model_name,
+            "embedding_name": self.embedding_name,
+            "thread_histories": {thread_id: history.to_list() for thread_id, history in self.thread_histories.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        chat_state = cls()
+        chat_state.safety_mode = data["safety_mode"]
+        chat_state.last_active = data["last_active"]
+        chat_state.model_name = data["model_name"]
+        chat_state.embedding_name = data["embedding_name"]
+        chat_state.thread_histories = {thread_id: ThreadHistory.from_list(turns)
+                                       for thread_id, turns in data["thread_histories"].items()}
+        return chat_state
+
+
+class InMemoryChatStateStore:
+    """
+    Chat states in a dict of this process, bounded by a global turn and byte budget.
+
+    Reads of existing users are lock-free dict lookups. A user idle for longer than timeout is dropped lazily
+    when looked up and by cleanup(), which only visits expired users since users are kept
+    in order of their last save and a save refreshes last_active. save(user_id, chat_state,
+    thread_id) accounts for the saved
+    thread; once max_turns or max_bytes is exceeded the least recently used threads of any
+    user are evicted. update() serializes read-modify-write per user through a fixed set of
+    striped locks; the bookkeeping lock is only held for these O(1) LRU updates.
+    """
+    def __init__(self, timeout=CHAT_STATE_TIMEOUT, max_turns=None, max_bytes=None, lock_stripes=64):
+        self.timeout = timeout
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self._states = {}
+        self._locks = [Lock() for _ in range(lock_stripes)]
+        self._lru_lock = Lock()
+        self._users = OrderedDict()
+        self._threads = OrderedDict()
+        self.total_turns = 0
+        self.total_bytes = 0
+        self.evicted_threads = 0
+        self.expired_users = 0
+
+    def get(self, user_id, create=True):
+        chat_state = self._states.get(user_id)
+        if chat_state is not None and self.timeout is not None and time.time() - chat_state.last_active > self.timeout:
+            with self._lru_lock:
+                self._drop_user(user_id)
+                self.expired_users += 1
+            chat_state = None
+        if chat_state is None and create:
+            with self._lru_lock:
+                # two threads creating the same user end up with one state, and it is tracked
+                # right away so cleanup() and the budget see it even if it is never saved
+                chat_state = self._states.setdefault(user_id, ChatState())
+                if user_id not in self._users:
+                    self._users[user_id] = None
+        return chat_state
+
+    def save(self, user_id, chat_state, thread_id=None):
+        with self._lru_lock:
+            # keeps _users in last_active order, which cleanup() relies on
+            chat_state.update_last_active()
+            self._states[user_id] = chat_state
+            self._users[user_id] = None
+            self._users.move_to_end(user_id)
+            history = chat_state.thread_histories.get(thread_id) if thread_id is not None else None
+            if history is None:
+                return
+            key = (user_id, thread_id)
+            turns, approx_bytes = self._threads.pop(key, (0, 0))
+            self.total_turns += len(history) - turns
+            self.total_bytes += history.approx_bytes - approx_bytes
+            self._threads[key] = (len(history), history.approx_bytes)
+            self._evict()
+
+    @contextmanager
+    def update(self, user_id, thread_id=None):
+        """
+        Yield the user's chat state and save it afterwards, atomically for that user.
+        thread_id is the thread the caller changed, if any, for the turn and byte budget.
+        """
+        with self._locks[hash(user_id) % len(self._locks)]:
+            chat_state = self.get(user_id)
+            yield chat_state
+            self.save(user_id, chat_state, thread_id)
+
+    def delete(self, user_id):
+        with self._lru_lock:
+            self._drop_user(user_id)
+
+    def cleanup(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        current_time = time.time()
+        with self._lru_lock:
+            while self._users:
+                user_id = next(iter(self._users))
+                chat_state = self._states.get(user_id)
+                if chat_state is not None and current_time - chat_state.last_active <= timeout:
+                    break
+                self._drop_user(user_id)
+                self.expired_users += 1
+
+    def _evict(self):
+        # never evict the thread that was just saved
+        while len(self._threads) > 1 and self._over_budget():
+            (user_id, thread_id), (turns, approx_bytes) = self._threads.popitem(last=False)
+            self.total_turns -= turns
+            self.total_bytes -= approx_bytes
+            self.evicted_threads += 1
+            chat_state = self._states.get(user_id)
+            if chat_state is not None:
+                chat_state.thread_histories.pop(thread_id, None)
+
+    def _over_budget(self):
+        if self.max_turns is not None and self.total_turns > self.max_turns:
+            return True
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _drop_user(self, user_id):
+        # called with the bookkeeping lock held
+        chat_state = self._states.pop(user_id, None)
+        self._users.pop(user_id, None)
+        if chat_state is None:
+            return
+        for thread_id in list(chat_state.thread_histories):
+            turns, approx_bytes = self._threads.pop((user_id, thread_id), (0, 0))
+            self.total_turns -= turns
+            self.total_bytes -= approx_bytes
+
+    def stats(self):
+        with self._lru_lock:
+            return {
+                "users": len(self._states),
+                "threads": len(self._threads),
+                "turns": self.total_turns,
+                "approx_bytes": self.total_bytes + len(self._states) * CHAT_STATE_OVERHEAD_BYTES,
+                "evicted_threads": self.evicted_threads,
+                "expired_users": self.expired_users,
+            }
+
+    def __len__(self):
+        return len(self._states)
+
+
+class SQLiteChatStateStore:
+    """
+    Chat states in a SQLite file that several worker processes can share.
+
+    Every user is one row holding the zlib-compressed JSON of their chat state, read and
+    written by key. The database runs in WAL mode so readers don't block the writer, and
+    update() takes the write lock (BEGIN IMMEDIATE) for its read-modify-write.
+    Every user keeps at most max_threads_per_user threads, the least recently saved ones
+    are dropped, and users idle for longer than timeout are treated as new.
+    """
+    def __init__(self, path='chat_state.db', busy_timeout=30, timeout=CHAT_STATE_TIMEOUT, max_threads_per_user=20):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.timeout = timeout
+        self.max_threads_per_user = max_threads_per_user
+        self._local = local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_states
+            (user_id text PRIMARY KEY, last_active real, state blob)
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS chat_states_last_active ON chat_states (last_active)')
+
+    def _conn(self):
+        # sqlite connections can't be shared between threads, keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id, create=True):
+        row = self._conn().execute('SELECT last_active, state FROM chat_states WHERE user_id = ?', (user_id,)).fetchone()
+        if row is not None and (self.timeout is None or time.time() - row[0] <= self.timeout):
+            return ChatState.from_dict(json.loads(zlib.decompress(row[1])))
+        return ChatState() if create else None
+
+    def save(self, user_id, chat_state, thread_id=None):
+        """
+        Replace the user's whole row. Anything written since chat_state was read is lost,
+        use update() to change part of a state other threads or processes may be changing.
+        """
+        self._trim(chat_state, thread_id)
+        self._write(self._conn(), user_id, chat_state)
+
+    def _trim(self, chat_state, thread_id):
+        if thread_id in chat_state.thread_histories:
+            # keep threads in order of use, the oldest are dropped first
+            chat_state.thread_histories[thread_id] = chat_state.thread_histories.pop(thread_id)
+        while self.max_threads_per_user is not None and len(chat_state.thread_histories) > self.max_threads_per_user:
+            chat_state.thread_histories.pop(next(iter(chat_state.thread_histories)))
+
+    def _write(self, conn, user_id, chat_state):
+        state = zlib.compress(json.dumps(chat_state.to_dict()).encode('utf-8'))
+        conn.execute('INSERT OR REPLACE INTO chat_states (user_id, last_active, state) VALUES (?, ?, ?)',
+                     (user_id, chat_state.last_active, state))
+
+    @contextmanager
+    def update(self, user_id, thread_id=None):
+        """
+        Yield the user's chat state and save it afterwards, atomically across processes.
+        thread_id is the thread the caller changed, if any, kept as the most recently used.
+        """
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            chat_state = self.get(user_id)
+            yield chat_state
+            self._trim(chat_state, thread_id)
+            self._write(conn, user_id, chat_state)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def delete(self, user_id):
+        self._conn().execute('DELETE FROM chat_states WHERE user_id = ?', (user_id,))
+
+    def cleanup(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        self._conn().execute('DELETE FROM chat_states WHERE last_active < ?', (time.time() - timeout,))
+
+    def stats(self):
+        users, approx_bytes = self._conn().execute('SELECT COUNT(*), TOTAL(LENGTH(state)) FROM chat_states').fetchone()
+        return {"users": users, "approx_bytes": int(approx_bytes)}
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM chat_states').fetchone()[0]
+
+
+class CleanupScheduler:
+    """ A single daemon thread calling store.cleanup() every interval seconds. """
+    def __init__(self, store, interval=600):
+        self.store = store
+        self.interval = interval
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="chat-state-cleanup", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.store.cleanup()
+            except Exception:
+                logger.exception("Chat state cleanup failed")
+
+
+chat_state_store = None
+cleanup_scheduler = None
+
+
+def init_chat_state_store(config):
+    """ Create the chat state store configured under chat_state in config.yaml (in memory by default). """
+    global chat_state_store, cleanup_scheduler
+    store_config = config.get('chat_state') or {}
+    timeout = store_config.get('timeout', CHAT_STATE_TIMEOUT)
+    if store_config.get('backend', 'memory') == 'sqlite':
+        chat_state_store = SQLiteChatStateStore(store_config.get('path', 'chat_state.db'), timeout=timeout,
+                                                max_threads_per_user=store_config.get('max_threads_per_user', 20))
+    else:
+        chat_state_store = InMemoryChatStateStore(timeout=timeout,
+                                                  max_turns=store_config.get('max_turns'),
+                                                  max_bytes=store_config.get('max_bytes'))
+    cleanup_scheduler = CleanupScheduler(chat_state_store, store_config.get('cleanup_interval', 600))
+    return chat_state_store
+
+
+def get_chat_state_store():
+    global chat_state_store
+    if chat_state_store is None:
+        chat_state_store = InMemoryChatStateStore()
+    return chat_state_store
+
+
+def start_cleanup_scheduler():
+    """ Start the expiry thread of the chat state store, only once per process. """
+    global cleanup_scheduler
+    if cleanup_scheduler is None:
+        cleanup_scheduler = CleanupScheduler(get_chat_state_store())
+    if not cleanup_scheduler.is_alive():
+        cleanup_scheduler.start()
+    return cleanup_scheduler
@@ -1,18 +1,93 @@
-from langchain.chains import ConversationalRetrievalChain
-from langchain.vectorstores import FAISS
+import time
+import logging
+from threading import Lock
+from index_registry import get_index_registry
+from model_dispatch import get_model_dispatcher
+
+logger = logging.getLogger(__name__)
 
 
 def initialize_chatbot(lazy_model, lazy_embedding, config):
-    
-    model = lazy_model.model
-    embeddings = lazy_embedding.embedding
-    embedding_vb_name = lazy_embedding.config['vb_name']
-    vb_config = next(vb for vb in config['vectordb'] if vb['vb_name'] == embedding_vb_name)
-    faiss_path = vb_config['path']
-    # load faiss index
-    db = FAISS.load_local(faiss_path, embeddings)
+    from langchain.chains import ConversationalRetrievalChain
+    dispatcher = get_model_dispatcher()
+    if dispatcher is not None:
+        model = dispatcher.wrap(lazy_model)
+        condense_model = dispatcher.wrap(lazy_model, condense=True)
+    else:
+        model = lazy_model.model
+        condense_model = lazy_model.condense_model
+    # faiss index is loaded once per process and shared by every chat state
+    retriever = get_index_registry(config).get_retriever(lazy_embedding, config)
     #initialize conversation retreival chain
-    retriever = db.as_retriever()
-    qa = ConversationalRetrievalChain.from_llm(model, retriever, verbose=True, return_source_documents=True)
+    qa = ConversationalRetrievalChain.from_llm(model, retriever, condense_question_llm=condense_model,
+                                               verbose=True, return_source_documents=True)
     #print(f'Chatbot initialized: {qa}')
-    return qa
\ No newline at end of file
+    return qa
+
+
+class ChainPool:
+    """
+    One ConversationalRetrievalChain per (model name, embedding name, safety mode), shared by
+    every user and thread.
+
+    The chain holds no per-conversation state, the thread history is passed in on every call,
+    so concurrent calls can share it. A chain is rebuilt when the registry swaps in a new
+    version of its index, and drop_index() removes the chains of an index the registry
+    evicted so they don't keep it in memory.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._build_locks = {}
+        self._chains = {}
+        self.hits = 0
+        self.builds = 0
+        self.dropped = 0
+        self.build_seconds = 0.0
+        self.last_build_seconds = 0.0
+
+    def get(self, lazy_model, lazy_embedding, safety_mode, config):
+        key = (lazy_model.config['name'], lazy_embedding.config['name'], safety_mode)
+        # cheap on a hit, and where the registry notices newly published index versions
+        db = get_index_registry(config).get(lazy_embedding, config)
+        with self._lock:
+            qa = self._chains.get(key)
+            if qa is not None and qa.retriever.vectorstore is db:
+                self.hits += 1
+                return qa
+            build_lock = self._build_locks.setdefault(key, Lock())
+        with build_lock:
+            with self._lock:
+                qa = self._chains.get(key)
+                if qa is not None and qa.retriever.vectorstore is db:
+                    return qa
+            start = time.perf_counter()
+            qa = initialize_chatbot(lazy_model, lazy_embedding, config)
+            elapsed = time.perf_counter() - start
+            logger.info(f"Built chain for {key} in {elapsed:.3f}s")
+            with self._lock:
+                self._chains[key] = qa
+                self.builds += 1
+                self.build_seconds += elapsed
+                self.last_build_seconds = elapsed
+        return qa
+
+    def drop_index(self, db):
+        """ Remove the chains retrieving from db, the index registry calls it when it drops db. """
+        with self._lock:
+            for key in [key for key, qa in self._chains.items() if qa.retriever.vectorstore is db]:
+                del self._chains[key]
+                self.dropped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chains": len(self._chains),
+                "hits": self.hits,
+                "builds": self.builds,
+                "dropped": self.dropped,
+                "build_seconds": self.build_seconds,
+                "last_build_seconds": self.last_build_seconds,
+            }
+
+
+chain_pool = ChainPool()
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+import pickle
+import argparse
+from setup_app import load_config
+from lazy_model import LazyEmbedding
+from index_registry import index_size_on_disk
+
+'''
+compare the recall and latency of a vectordb index against a flat baseline on held-out queries
+
+usage (from the repository root):
+    python -m data_process.evaluate_index --embedding openai-embedding --queries held_out.txt \
+        --baseline /path/to/flat.faiss --nprobe 1 8 32 --k 4
+'''
+
+
+def load_index(directory):
+    import faiss
+    index = faiss.read_index(os.path.join(directory, 'index.faiss'))
+    with open(os.path.join(directory, 'index.pkl'), 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return index, docstore, index_to_docstore_id
+
+
+def load_queries(path):
+    """ One query per line, or JSONL lines with a "question" field. """
+    queries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            queries.append(json.loads(line)['question'] if path.endswith('.jsonl') else line)
+    return queries
+
+
+def result_keys(labels, docstore, index_to_docstore_id):
+    # chunk ids differ between two builds, compare the chunks themselves
+    keys = set()
+    for label in labels:
+        if label < 0:
+            continue
+        doc = docstore.search(index_to_docstore_id[int(label)])
+        keys.add((doc.metadata.get('source'), doc.page_content))
+    return keys
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def timed_search(index, vectors, k):
+    labels = []
+    latencies = []
+    for vector in vectors:
+        start = time.perf_counter()
+        _, found = index.search(vector.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        labels.append(found[0])
+    return labels, latencies
+
+
+def evaluate(candidate_dir, baseline_dir, vectors, k, settings):
+    """
+    Search every query vector in both indexes, once per parameter setting of the candidate.
+    Each setting is applied to a fresh copy of the candidate, so unset parameters keep their defaults.
+
+    Args:
+        settings (list[dict]): faiss ParameterSpace settings to try, e.g. [{"nprobe": 8}].
+    Returns:
+        (list[dict]): recall@k and per query latency in ms for the baseline and each setting.
+    """
+    import faiss
+    baseline, baseline_docstore, baseline_ids = load_index(baseline_dir)
+    candidate, candidate_docstore, candidate_ids = load_index(candidate_dir)
+    baseline_labels, baseline_latencies = timed_search(baseline, vectors, k)
+    expected = [result_keys(labels, baseline_docstore, baseline_ids) for labels in baseline_labels]
+    rows = [_report_row('baseline (flat)', 1.0, baseline_latencies, index_size_on_disk(baseline_dir))]
+    parameter_space = faiss.ParameterSpace()
+    for setting in settings or [{}]:
+        # every setting starts from the index as loaded, not from the previous setting's parameters
+        index = faiss.clone_index(candidate)
+        for name, value in setting.items():
+            parameter_space.set_index_parameter(index, name, value)
+        labels, latencies = timed_search(index, vectors, k)
+        recalls = [len(result_keys(found, candidate_docstore, candidate_ids) & want) / len(want)
+                   for found, want in zip(labels, expected) if want]
+        name = ', '.join(f'{key}={value}' for key, value in setting.items()) or 'default'
+        rows.append(_report_row(name, sum(recalls) / len(recalls) if recalls else 0.0, latencies,
+                                index_size_on_disk(candidate_dir)))
+    return rows
+
+
+def _report_row(name, recall, latencies, size):
+    return {
+        "setting": name,
+        "recall": recall,
+        "mean_ms": sum(latencies) / len(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "index_bytes": size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a vectordb index against a flat baseline.")
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--embedding', required=True, help="name of the embedding in config.yaml")
+    parser.add_argument('--queries', required=True, help="held-out queries, one per line or JSONL with question")
+    parser.add_argument('--baseline', required=True, help="directory of a Flat index built from the same source")
+    parser.add_argument('--k', type=int, default=None, help="defaults to search.k of the vectordb entry, or 4")
+    parser.add_argument('--nprobe', type=int, nargs='*', default=[], help="nprobe values to try (IVF)")
+    parser.add_argument('--ef-search', type=int, nargs='*', default=[], help="efSearch values to try (HNSW)")
+    parser.add_argument('--output', help="also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    import numpy as np
+    config = load_config(args.config)[0]
+    embedding_config = next(e for e in config['embeddings'] if e['name'] == args.embedding)
+    vb_config = next(vb for vb in config['vectordb'] if vb['vb_name'] == embedding_config['vb_name'])
+    k = args.k or (vb_config.get('search') or {}).get('k', 4)
+    queries = load_queries(args.queries)
+    # embedded the way the bot embeds questions, instruct embeddings use a different instruction for queries
+    embedding = LazyEmbedding(embedding_config).embedding
+    vectors = np.asarray([embedding.embed_query(query) for query in queries], dtype=np.float32)
+    settings = [{'nprobe': n} for n in args.nprobe] + [{'efSearch': ef} for ef in args.ef_search]
+
+    rows = evaluate(vb_config['path'], args.baseline, vectors, k, settings)
+    print(f"{len(queries)} queries, recall@{k}, index type {(vb_config.get('index') or {}).get('type', 'Flat')}")
+    print(f"{'setting':<20} {'recall':>8} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'MB':>9}")
+    for row in rows:
+        print(f"{row['setting']:<20} {row['recall']:>8.3f} {row['mean_ms']:>9.3f} {row['p50_ms']:>9.3f} "
+              f"{row['p95_ms']:>9.3f} {row['index_bytes'] / 2**20:>9.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"k": k, "queries": len(queries), "rows": rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,445 @@
+import os
+import json
+import time
+import hashlib
+import pickle
+import shutil
+import logging
+import argparse
+import tempfile
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from setup_app import load_config
+from lazy_model import LazyEmbedding
 
+'''
+build the faiss index of a vectordb entry from source documents
 
+usage (from the repository root):
+    python -m data_process.index_data --embedding openai-embedding --source docs/
+    python -m data_process.index_data --embedding hf-sentence-transformer --source docs.jsonl --workers 4
+    python -m data_process.index_data --embedding openai-embedding --source docs/ --incremental
+    python -m data_process.index_data --embedding openai-embedding --source docs/ --index-type Flat --path flat.faiss
+'''
 
+logger = logging.getLogger(__name__)
+
+TEXT_EXTENSIONS = ('.txt', '.md', '.rst', '.html')
+INDEX_TYPES = ('Flat', 'IVFFlat', 'IVFPQ', 'HNSW')
+
+
+def iter_documents(source):
+    """
+    Yield documents one at a time from a directory of text files or a JSONL file.
+
+    JSONL lines need a "text" (or "page_content") field, the remaining fields become metadata.
+    "source" defaults to the file path and the record's "id" field, or a hash of the record
+    when it has none, so inserting or removing lines doesn't change the keys of the others.
+    """
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if not name.endswith(TEXT_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                with open(path, encoding='utf-8', errors='ignore') as f:
+                    yield Document(page_content=f.read(), metadata={'source': path})
+    else:
+        with open(source, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if 'source' not in record:
+                    key = record.get('id')
+                    if key is None:
+                        key = hashlib.sha256(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+                    record['source'] = f'{source}#{key}'
+                text = record.pop('text', None) or record.pop('page_content', '')
+                yield Document(page_content=text, metadata=record)
+
+
+def iter_chunks(documents, chunk_size=1000, chunk_overlap=100):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    for document in documents:
+        yield from splitter.split_documents([document])
+
+
+def iter_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+_worker_embedding = None
+
+
+def _init_worker(embedding_config):
+    # each worker process loads the model once
+    global _worker_embedding
+    _worker_embedding = LazyEmbedding(embedding_config).embedding
+
+
+def _embed_in_worker(texts):
+    return _worker_embedding.embed_documents(texts)
+
+
+class BatchEmbedder:
+    """
+    Embed batches of texts concurrently, returning results in submission order.
+
+    Local HuggingFace models run in a process pool, one model per process, and API
+    embeddings (OpenAI) run in a thread pool since they only wait on the network.
+    At most max_pending batches are in flight, which bounds memory use.
+    """
+    def __init__(self, embedding_config, workers=4, max_pending=None):
+        if embedding_config['type'] == 'OpenAIEmbeddings':
+            embedding = LazyEmbedding(embedding_config).embedding
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+            self._embed = embedding.embed_documents
+        else:
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                 initargs=(embedding_config,))
+            self._embed = _embed_in_worker
+        self.max_pending = max_pending or workers * 2
+
+    def embed(self, batches):
+        """ Yield (batch, vectors) pairs in the order the batches came in. """
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, self._executor.submit(self._embed, [chunk.page_content for chunk in batch])))
+            if len(pending) >= self.max_pending:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+        while pending:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def index_factory_string(index_config, n_vectors=None):
+    """
+    The faiss index_factory description of the index type in a vectordb entry's index section.
+
+    IVF types get nlist clusters, reduced for small corpora since faiss wants about 39 training
+    vectors per cluster. PQ needs at least 2**nbits training vectors, which can't be reduced
+    away, so smaller corpora raise a ValueError. Flat and HNSW are wrapped in IDMap2 so vectors
+    can be stored under chunk ids, IVF indexes store ids natively.
+    """
+    index_type = index_config.get('type', 'Flat')
+    nlist = index_config.get('nlist', 1024)
+    if n_vectors is not None:
+        nlist = max(1, min(nlist, n_vectors // 39))
+    if index_type == 'Flat':
+        return 'IDMap2,Flat'
+    if index_type == 'IVFFlat':
+        return f'IVF{nlist},Flat'
+    if index_type == 'IVFPQ':
+        nbits = index_config.get("nbits", 8)
+        if n_vectors is not None and n_vectors < 2 ** nbits:
+            raise ValueError(f"IVFPQ with nbits={nbits} needs at least {2 ** nbits} training vectors, got {n_vectors}; "
+                             f"lower nbits or use a Flat index for this corpus")
+        return f'IVF{nlist},PQ{index_config.get("m", 16)}x{nbits}'
+    if index_type == 'HNSW':
+        return f'IDMap2,HNSW{index_config.get("hnsw_m", 32)}'
+    raise ValueError(f"Unknown index type {index_type}, expected one of {INDEX_TYPES}")
+
+
+class IndexWriter:
+    """
+    Collect vectors and chunks into a FAISS index in the format FAISS.save_local writes.
+
+    Vectors are stored under int64 chunk ids, which double as docstore ids, so the chunks of
+    a document can be removed again. documents is the manifest: the content hash and chunk
+    ids of every source document, saved next to the index.
+
+    The index type comes from index_config (the index section of the vectordb entry). IVF
+    types are trained on the first train_size vectors, which are held back until then.
+    Flat and HNSW need no training and add vectors as they come.
+    """
+    def __init__(self, index_config=None):
+        self.index_config = index_config or {}
+        self.index = None
+        self.docs = {}
+        self.index_to_docstore_id = {}
+        self.documents = {}
+        self.next_id = 0
+        self._removed_ids = []
+        self._untrained = []
+
+    @classmethod
+    def load(cls, directory, index_config=None):
+        """
+        Load a published index with its manifest to update it.
+        Returns None if it has no manifest, was built with a different index configuration,
+        or is an HNSW index, which can't remove vectors.
+        """
+        import faiss
+        manifest_path = os.path.join(directory, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            logger.warning(f"{directory} has no manifest")
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        writer = cls(index_config)
+        if manifest.get('index_config', {}) != writer.index_config:
+            logger.warning(f"{directory} was built with index config {manifest.get('index_config')}")
+            return None
+        if writer.index_config.get('type') == 'HNSW':
+            logger.warning("HNSW indexes can't remove vectors")
+            return None
+        writer.index = faiss.read_index(os.path.join(directory, 'index.faiss'))
+        with open(os.path.join(directory, 'index.pkl'), 'rb') as f:
+            docstore, writer.index_to_docstore_id = pickle.load(f)
+        writer.docs = docstore._dict
+        writer.documents = manifest['documents']
+        writer.next_id = manifest['next_id']
+        return writer
+
+    def is_empty(self):
+        return self.index is None and not self._untrained
+
+    def start_document(self, source, content_hash):
+        self.documents[source] = {'hash': content_hash, 'chunk_ids': []}
+
+    def remove_document(self, source):
+        # vectors are removed in one pass in save(), removing from a flat index is linear in its size
+        for chunk_id in self.documents.pop(source)['chunk_ids']:
+            self.docs.pop(self.index_to_docstore_id.pop(chunk_id), None)
+            self._removed_ids.append(chunk_id)
+
+    def add(self, chunks, vectors):
+        import numpy as np
+        matrix = np.asarray(vectors, dtype=np.float32)
+        ids = np.arange(self.next_id, self.next_id + len(chunks), dtype=np.int64)
+        self.next_id += len(chunks)
+        for chunk, chunk_id in zip(chunks, ids.tolist()):
+            self.docs[str(chunk_id)] = chunk
+            self.index_to_docstore_id[chunk_id] = str(chunk_id)
+            self.documents[chunk.metadata['source']]['chunk_ids'].append(chunk_id)
+        if self.index is None and self.index_config.get('type', 'Flat') in ('Flat', 'HNSW'):
+            # their factory string doesn't depend on the number of vectors, create them right away
+            self.index = self._new_index(matrix.shape[1])
+        if self.index is not None and self.index.is_trained:
+            self.index.add_with_ids(matrix, ids)
+            return
+        self._untrained.append((matrix, ids))
+        if sum(len(pending) for pending, _ in self._untrained) >= self.index_config.get('train_size', 50000):
+            self._train()
+
+    def _train(self):
+        import faiss
+        import numpy as np
+        matrix = np.vstack([pending for pending, _ in self._untrained])
+        ids = np.concatenate([pending_ids for _, pending_ids in self._untrained])
+        self._untrained = []
+        if self.index is None:
+            self.index = self._new_index(matrix.shape[1], len(matrix))
+        if not self.index.is_trained:
+            start = time.perf_counter()
+            self.index.train(matrix)
+            logger.info(f"Trained {self.index_config.get('type')} index on {len(matrix)} vectors "
+                        f"in {time.perf_counter() - start:.1f}s")
+        self.index.add_with_ids(matrix, ids)
+
+    def _new_index(self, dim, n_vectors=None):
+        import faiss
+        index = faiss.index_factory(dim, index_factory_string(self.index_config, n_vectors))
+        if self.index_config.get('type') == 'HNSW':
+            faiss.downcast_index(index.index).hnsw.efConstruction = self.index_config.get('ef_construction', 200)
+        return index
+
+    def save(self, directory):
+        import faiss
+        import numpy as np
+        if self._untrained:
+            # fewer than train_size vectors in total, train on all of them
+            self._train()
+        if self._removed_ids:
+            self.index.remove_ids(np.asarray(self._removed_ids, dtype=np.int64))
+            self._removed_ids = []
+        os.makedirs(directory, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(directory, 'index.faiss'))
+        with open(os.path.join(directory, 'index.pkl'), 'wb') as f:
+            pickle.dump((InMemoryDocstore(self.docs), self.index_to_docstore_id), f)
+        with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+            json.dump({'next_id': self.next_id, 'index_config': self.index_config, 'documents': self.documents}, f)
+
+
+def document_hash(document):
+    content = document.page_content + json.dumps(document.metadata, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def select_documents(documents, writer, counts):
+    """
+    Yield only the documents that are new or changed compared to the writer's manifest.
+
+    The old chunks of changed documents are removed before their new chunks are added, and
+    once the source is exhausted the documents that are no longer in it are removed too.
+    counts is updated with the number of added, changed, unchanged and deleted documents.
+    """
+    seen = set()
+    for document in documents:
+        source = document.metadata['source']
+        seen.add(source)
+        content_hash = document_hash(document)
+        entry = writer.documents.get(source)
+        if entry is not None and entry['hash'] == content_hash:
+            counts['unchanged'] += 1
+            continue
+        if entry is not None:
+            writer.remove_document(source)
+            counts['changed'] += 1
+        else:
+            counts['added'] += 1
+        writer.start_document(source, content_hash)
+        yield document
+    for source in [source for source in writer.documents if source not in seen]:
+        writer.remove_document(source)
+        counts['deleted'] += 1
+
+
+def publish_index(writer, path, keep_versions=2):
+    """
+    Write the index to a new versioned directory next to path and atomically repoint path at it.
+
+    path becomes a symlink to the newest version, so readers always see either the old
+    or the new index in full. Every publish writes to a directory of its own, never into
+    the version being served. A plain directory at path from before is kept as the first
+    version. Only the newest keep_versions versions are kept.
+
+    Returns:
+        (str): The directory of the new version.
+    """
+    path = os.path.abspath(path)
+    parent, base = os.path.split(path)
+    # mkdtemp never reuses a name, two publishes within the same second get their own directories
+    version_dir = tempfile.mkdtemp(dir=parent, prefix=f'{base}.v{time.strftime("%Y%m%d%H%M%S")}-')
+    os.chmod(version_dir, 0o755)
+    writer.save(version_dir)
+    if os.path.isdir(path) and not os.path.islink(path):
+        os.rename(path, f'{path}.v0')
+        os.symlink(os.path.basename(f'{path}.v0'), path)
+    tmp_link = f'{path}.tmp-{os.getpid()}'
+    os.symlink(os.path.basename(version_dir), tmp_link)
+    os.replace(tmp_link, path)
+    prune_versions(path, keep_versions)
+    return version_dir
+
+
+def prune_versions(path, keep_versions):
+    parent, base = os.path.split(path)
+    current = os.path.realpath(path)
+    versions = sorted((os.path.join(parent, name) for name in os.listdir(parent) if name.startswith(f'{base}.v')),
+                      key=os.path.getmtime, reverse=True)
+    for old in versions[keep_versions:]:
+        if os.path.realpath(old) != current:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+class Progress:
+    def __init__(self, every=10):
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.every = every
+        self.docs = 0
+        self.vectors = 0
+
+    def update(self, docs=0, vectors=0):
+        self.docs += docs
+        self.vectors += vectors
+        now = time.perf_counter()
+        if now - self.last_report >= self.every:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        logger.info(f"{self.docs} docs ({self.docs / elapsed:.1f} docs/s), "
+                    f"{self.vectors} vectors ({self.vectors / elapsed:.1f} vectors/s) in {elapsed:.1f}s")
+
+
+def build_index(source, embedding_config, path, batch_size=64, workers=4, chunk_size=1000, chunk_overlap=100,
+                incremental=False, index_config=None):
+    """
+    Build the index at path from source and publish it as a new version.
+
+    With incremental=True the current version at path is loaded together with its manifest and
+    only new or changed documents are embedded; the chunks of changed and deleted documents are
+    removed. An index that can't be updated in place is rebuilt from scratch.
+    index_config is the index section of the vectordb entry and selects the index type.
+    """
+    progress = Progress()
+    writer = None
+    if incremental and os.path.exists(path):
+        writer = IndexWriter.load(path, index_config)
+        if writer is None:
+            logger.warning(f"Rebuilding {path} from scratch")
+    writer = writer or IndexWriter(index_config)
+    counts = {'added': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0}
+
+    def counted_documents():
+        for document in iter_documents(source):
+            progress.update(docs=1)
+            yield document
+
+    embedder = BatchEmbedder(embedding_config, workers=workers)
+    try:
+        documents = select_documents(counted_documents(), writer, counts)
+        chunks = iter_chunks(documents, chunk_size, chunk_overlap)
+        for batch, vectors in embedder.embed(iter_batches(chunks, batch_size)):
+            writer.add(batch, vectors)
+            progress.update(vectors=len(vectors))
+    finally:
+        embedder.close()
+    if writer.is_empty():
+        raise ValueError(f"No documents found in {source}")
+    progress.report()
+    logger.info(f"Documents: {counts}")
+    if incremental and counts['added'] == counts['changed'] == counts['deleted'] == 0:
+        logger.info(f"{path} is up to date")
+        return os.path.realpath(path)
+    version_dir = publish_index(writer, path)
+    logger.info(f"Wrote {len(writer.index_to_docstore_id)} vectors to {version_dir}")
+    return version_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the FAISS index of a vectordb entry from source documents.")
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--embedding', required=True, help="name of the embedding in config.yaml")
+    parser.add_argument('--source', required=True, help="directory of text files or a JSONL file")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--chunk-overlap', type=int, default=100)
+    parser.add_argument('--path', help="write here instead of the vectordb path, e.g. for a flat baseline")
+    parser.add_argument('--index-type', choices=INDEX_TYPES, help="override the index type of the vectordb entry")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only embed new or changed documents and drop deleted ones from the current index")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] - %(message)s')
+    config = load_config(args.config)[0]
+    embedding_config = next(e for e in config['embeddings'] if e['name'] == args.embedding)
+    vb_config = next(vb for vb in config['vectordb'] if vb['vb_name'] == embedding_config['vb_name'])
+    index_config = dict(vb_config.get('index') or {})
+    if args.index_type:
+        index_config['type'] = args.index_type
+    build_index(args.source, embedding_config, args.path or vb_config['path'], batch_size=args.batch_size,
+                workers=args.workers, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+                incremental=args.incremental, index_config=index_config)
+
+
+if __name__ == '__main__':
+    main()
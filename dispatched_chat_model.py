@@ -0,0 +1,36 @@
+import asyncio
+from functools import partial
+from typing import Any
+from langchain.chat_models.base import BaseChatModel
+
+''' chat model handing its calls to the model dispatcher, kept apart so startup doesn't import langchain '''
+
+
+class DispatchedChatModel(BaseChatModel):
+    """
+    What the chains call instead of a model. Every call goes through ModelDispatcher, which
+    picks the model (model_name or its fallback), applies its limits and retries.
+    Callbacks, and with them streaming, are passed on to the model doing the call.
+    """
+    dispatcher: Any
+    model_name: str
+    condense: bool = False
+
+    @property
+    def _llm_type(self):
+        return "dispatched-chat"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt_chars = sum(len(message.content) for message in messages)
+        return self.dispatcher.generate(self.model_name, self.condense, prompt_chars,
+                                        lambda model: model._generate(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        # the limits wait on thread locks, so the call runs on the loop's executor, not on the loop
+        sync_run_manager = run_manager.get_sync() if run_manager is not None else None
+        return await asyncio.get_running_loop().run_in_executor(
+            None, partial(self._generate, messages, stop=stop, run_manager=sync_run_manager, **kwargs))
+
+    def _combine_llm_outputs(self, llm_outputs):
+        # the wrapped model sums its token usage, which the tracing callbacks count
+        return self.dispatcher.models[self.model_name].model._combine_llm_outputs(llm_outputs)
@@ -0,0 +1,83 @@
+import time
+import queue
+import logging
+from threading import Thread, Lock
+from concurrent.futures import Future
+from langchain.embeddings.base import Embeddings
+
+''' micro-batching of concurrent query embeddings for local embedding models '''
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class BatchingEmbedding(Embeddings):
+    """
+    Embeddings wrapper that runs concurrent embed_query calls as one batched forward pass.
+
+    The first waiting query opens a window of max_wait_ms milliseconds; every query arriving
+    within it, up to max_batch_size, is embedded together with embed_documents and each caller
+    gets its own vector back. Only use it for models whose query and document embeddings are
+    the same, like HuggingFaceEmbeddings. embed_documents is passed straight through.
+    """
+    def __init__(self, embedding, max_wait_ms=10, max_batch_size=32):
+        self.embedding = embedding
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._stats_lock = Lock()
+        self.batches = 0
+        self.queries = 0
+        self.batch_size_counts = {bucket: 0 for bucket in BATCH_SIZE_BUCKETS}
+        self._thread = Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def embed_query(self, text):
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def embed_documents(self, texts):
+        return self.embedding.embed_documents(texts)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._embed_batch(batch)
+
+    def _embed_batch(self, batch):
+        try:
+            vectors = self.embedding.embed_documents([text for text, _ in batch])
+        except Exception as e:
+            logger.exception(f"Embedding a batch of {len(batch)} queries failed")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+        with self._stats_lock:
+            self.batches += 1
+            self.queries += len(batch)
+            bucket = next((b for b in BATCH_SIZE_BUCKETS if len(batch) <= b), BATCH_SIZE_BUCKETS[-1])
+            self.batch_size_counts[bucket] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "batches": self.batches,
+                "queries": self.queries,
+                "avg_batch_size": self.queries / self.batches if self.batches else 0.0,
+                "queue_depth": self._queue.qsize(),
+                # histogram buckets are upper bounds on the batch size
+                "batch_size_histogram": dict(self.batch_size_counts),
+            }
@@ -1,51 +1,39 @@
-from threading import Lock
 from utils import *
-import json
-from setup_app import app, bot_id, slack_client
-from chatbot import initialize_chatbot
+from setup_app import get_bot
+from chatbot import chain_pool
 from slack_db import record_interaction_in_database
-import time
-from threading import Timer
-
-
-user_chat_states_lock = Lock()
-user_chat_states = {}
-
-class ChatState:
-    def __init__(self):
-        self.safety_mode = False
-        self.thread_histories = {}
-        self.last_active = time.time()
-        self.chatbot_instance = None 
-
-    def set_safety_mode(self, mode):
-        self.safety_mode = mode
-
-    def get_safety_mode(self):
-        return self.safety_mode
-    
-    def get_thread_history(self, thread_id):
-        return self.thread_histories.get(thread_id, [])
-    
-    def set_thread_history(self, thread_id, history):
-        self.thread_histories[thread_id] = history
-
-    def set_chatbot_instance(self, chatbot):
-        self.chatbot_instance = chatbot
- 
-    def get_chatbot_instance(self):
-        return self.chatbot_instance
-    
-    def update_last_active(self):
-        self.last_active = time.time()
+from chat_state_store import get_chat_state_store, start_cleanup_scheduler
+from answer_cache import get_answer_cache
+from slack_search import get_slack_search
+from tracing import start_trace
 
 
 def handle_message_events(body, logger):
     logger.info(body)
 
-def handle_mentions(body, say, logger, config):
+def handle_mentions(body, say, logger):
+    """
+    Answer a mention while tracing it: the time of every stage, token counts and whether
+    the answer cache hit are recorded in the /metrics histograms and logged as one JSON line.
+    """
+    bot = get_bot()
+    trace = start_trace(body.get("event_id") or body["event"]["ts"])
+    try:
+        answer_mention(body, say, logger, bot, trace)
+    except Exception:
+        trace.status = "error"
+        raise
+    finally:
+        trace.finish(log=(bot.config.get('tracing') or {}).get('log', True))
+
+def answer_mention(body, say, logger, bot, trace):
+    # langchain is imported with the first chain, not at startup
+    from streaming import SlackStreamingHandler
+    from tracing_callbacks import TracingCallbackHandler
+    config = bot.config
+    slack_client = bot.slack_client
     user_message = body["event"]["text"]
-    bot_user_id = bot_id
+    bot_user_id = bot.bot_id
     channel_id = body["event"]["channel"]
     mention = f"<@{bot_user_id}>"
     user_message = user_message.replace(mention, "").strip()
@@ -54,33 +42,66 @@ def handle_mentions(body, say, logger, config):
     thread_ts = body["event"]["thread_ts"] if "thread_ts" in body["event"] else ts
     is_new_conversation = (ts == thread_ts)
 
-    with user_chat_states_lock:
-        if user_id not in user_chat_states:
-            user_chat_states[user_id] = ChatState()      
-
-    chat_state = user_chat_states[user_id]
-    chat_state.update_last_active()
+    with trace.stage("chat_state"):
+        chat_state_store = get_chat_state_store()
+        # a snapshot, the changes of this mention are written back in one update() below
+        chat_state = chat_state_store.get(user_id)
     safety_mode = chat_state.get_safety_mode()
     history = chat_state.get_thread_history(thread_ts)
     session_type = 'mention'
 
-    if is_new_conversation or chat_state.get_chatbot_instance() is None:
-        model_name, embedding_name = get_model_and_embedding(safety_mode, user_message, say, ts)
-        lazy_model, lazy_embedding = get_lazy_model_and_embedding(model_name, embedding_name)
-        qa = initialize_chatbot(lazy_model, lazy_embedding, config)
-        chat_state.set_chatbot_instance(qa)
-    else:
-        qa = chat_state.get_chatbot_instance()
+    picked_model = is_new_conversation or chat_state.model_name is None
+    with trace.stage("model_parsing"):
+        if picked_model:
+            model_name, embedding_name = get_model_and_embedding(safety_mode, user_message, say, ts,
+                                                                 bot.available_models, bot.available_embeddings)
+        else:
+            model_name, embedding_name = chat_state.model_name, chat_state.embedding_name
+        lazy_model, lazy_embedding = get_lazy_model_and_embedding(model_name, embedding_name, bot.models, bot.embeddings)
+    trace.labels.update(model=model_name, embedding=embedding_name)
+    # the turns sent with the question, history gets this turn appended (and may be trimmed) below
+    history_length = len(history)
+    trace.set("history_turns", history_length)
+    with trace.stage("chain_init"):
+        # chains are shared by everyone using the same model and embedding, the thread only keeps its history
+        qa = chain_pool.get(lazy_model, lazy_embedding, safety_mode, config)
 
     user_message = clean_user_message(user_message)
-    response, answer, history = get_response_and_history(qa, user_message, history)
-    chat_state.set_thread_history(thread_ts, history)
+    callbacks = [TracingCallbackHandler(trace, has_history=history_length > 0)]
+    streamer = None
+    if lazy_model.config.get('streaming'):
+        # post a placeholder right away and fill it in as tokens arrive
+        streamer = SlackStreamingHandler(slack_client, channel_id, ts,
+                                         interval_ms=lazy_model.config.get('stream_interval_ms', 1000))
+        with trace.stage("post_message"):
+            streamer.start()
+        callbacks.append(streamer)
+    try:
+        response, answer, history = get_response_and_history(qa, user_message, history, lazy_model,
+                                                             answer_cache=get_answer_cache(config),
+                                                             lazy_embedding=lazy_embedding,
+                                                             cache_namespace=(model_name, embedding_name, safety_mode),
+                                                             callbacks=callbacks)
+    except Exception:
+        # don't leave the placeholder in the thread as if the answer were still coming
+        if streamer:
+            streamer.fail("Sorry, something went wrong while answering. Please try again.")
+        raise
+    with trace.stage("chat_state"):
+        # read-modify-write of only this thread, so a /safety_mode toggle or another thread's
+        # mention that happened while the model was answering isn't overwritten
+        with chat_state_store.update(user_id, thread_ts) as latest:
+            latest.update_last_active()
+            latest.set_thread_history(thread_ts, history)
+            if picked_model and latest.safety_mode == safety_mode:
+                latest.set_model_and_embedding(model_name, embedding_name)
     formatted_response, formatted_sources = format_response(response, answer)
 
     if safety_mode:
         print(safety_mode)
-        channels = ["<intentially left blank>"]
-        context = search_messages(user_message, channels, user_id)
+        channels = (config.get('slack_search') or {}).get('channels', ["<intentially left blank>"])
+        with trace.stage("slack_search"):
+            context = search_messages(user_message, channels, user_id, bot.slack_user_client, config)
         print(context)
         for match in context:
             ref_channel_name = match["channel_name"]
@@ -89,9 +110,13 @@ def handle_mentions(body, say, logger, config):
         # Add a message with the channel, thread and matching message
             formatted_response += f"\n\nYou might also find more information in the thread <{permalink}|link> in Slack channel <#{ref_channel_id}|{ref_channel_name}>."
 
-    bot_response = slack_client.chat_postMessage(channel=channel_id, text=formatted_response, thread_ts=ts)
+    with trace.stage("post_message"):
+        if streamer:
+            bot_response = streamer.finish(formatted_response)
+            trace.set("first_token_seconds", streamer.first_token_seconds)
+        else:
+            bot_response = slack_client.chat_postMessage(channel=channel_id, text=formatted_response, thread_ts=ts)
     bot_response_ts = bot_response['ts']
-    history_string = json.dumps(history)
     
     logger.info(f"User ID: {body['event']['user']}")
     logger.info(f"User Message: {user_message}")
@@ -99,17 +124,20 @@ def handle_mentions(body, say, logger, config):
     logger.info(f"Embedding Name: {embedding_name}")
     logger.info(f"Response: {answer}")
     logger.info(f"source documents: {formatted_sources}")
-    logger.info(f"history: {history}")
-    record_interaction_in_database(user_id, 
-                                   session_type, 
-                                   model_name=model_name, 
-                                   embedding_name=embedding_name, 
-                                   user_question=user_message,
-                                   user_question_ts=ts, 
-                                   bot_response=formatted_response, 
-                                   bot_response_ts=bot_response_ts,
-                                   formatted_sources=formatted_sources,
-                                   history=history_string)
+    logger.info(f"history: {history.as_chat_history()}")
+    with trace.stage("db_write"):
+        record_interaction_in_database(user_id, 
+                                       session_type, 
+                                       channel_id=channel_id,
+                                       thread_ts=thread_ts,
+                                       model_name=model_name, 
+                                       embedding_name=embedding_name, 
+                                       user_question=user_message,
+                                       user_question_ts=ts, 
+                                       bot_response=formatted_response, 
+                                       bot_response_ts=bot_response_ts,
+                                       formatted_sources=formatted_sources,
+                                       history_length=history_length)
 
 def handle_reaction(body, logger):
     logger.info(f"Reaction added event triggered.")
@@ -125,6 +153,7 @@ def handle_reaction(body, logger):
     if reaction in ['-1', '+1']:
         record_interaction_in_database(user_id,
                                        session_type, 
+                                       channel_id=item.get('channel'),
                                        user_reaction = reaction, 
                                        bot_response_ts=item['ts'],
                                        user_reaction_ts=user_reaction_ts)
@@ -132,74 +161,39 @@ def handle_reaction(body, logger):
 
 def activate_safety_mode(ack, command):
     user_id = command["user_id"]
-    # Get the chat state for the user
-    chat_state = user_chat_states.get(user_id)
-    if not chat_state:
-        chat_state = ChatState()
-        user_chat_states[user_id] = chat_state
-    # Update safety_mode
-    chat_state.safety_mode = not chat_state.safety_mode
-    chat_state.chatbot_instance = None
-    safety_mode = chat_state.safety_mode 
+    # Get the chat state for the user and update safety_mode
+    with get_chat_state_store().update(user_id) as chat_state:
+        # toggling counts as activity, or the state could expire right after with the new mode
+        chat_state.update_last_active()
+        chat_state.safety_mode = not chat_state.safety_mode
+        chat_state.reset_chatbot()
+        safety_mode = chat_state.safety_mode 
 
     if safety_mode:
         message = "Safety mode activated. The model is set to <blank> models and hugging face embeddings."
     else:
         message = "Safety mode deactivated. You can now select the model and embedding of your choice."
-    slack_client.chat_postMessage(channel=user_id, text=message)
+    get_bot().slack_client.chat_postMessage(channel=user_id, text=message)
     ack()  
 
 
 def cleanup_inactive_chatbots(timeout):
-    current_time = time.time()
-    with user_chat_states_lock:
-        # Use list() to copy keys to a new list, because we can't modify the dictionary during iteration
-        for key in list(user_chat_states.keys()):
-            if current_time - user_chat_states[key].last_active > timeout:
-                del user_chat_states[key]
+    get_chat_state_store().cleanup(timeout)
 
 def periodic_cleanup():
-    cleanup_inactive_chatbots(600)  # Cleanup instances inactive for more than an hour
-    Timer(600, periodic_cleanup).start()  # Run cleanup every 10 minutes
+    # one scheduler thread drops chat states inactive for longer than chat_state.timeout (CHAT_STATE_TIMEOUT by default)
+    start_cleanup_scheduler()
 
 
-def search_messages(query, channels, user_id, slack_user_client):
+def search_messages(query, channels, user_id, slack_user_client, config=None):
     """
     let the model search through the channel history (that the app is installed) for the query and retreive info together with
     knowledge base to answer the question. This feature only works in safety mode
     """
     # Get the chat state for the user
-    chat_state = user_chat_states.get(user_id)
+    chat_state = get_chat_state_store().get(user_id, create=False)
     if not chat_state or not chat_state.safety_mode:
         # Safety mode not activated, return empty list or raise an error
         return []
 
-    search_message_list = []
-    keyword_query = extract_keywords(query)
-    for channel in channels:
-        channel_query = f'{keyword_query} in:{channel}'
-        response = slack_user_client.search_messages(query=channel_query, 
-                                                     sort='timestamp', 
-                                                     sort_dir='desc', 
-                                                     count=5)
-        if response["ok"]:
-            matches = response["messages"]["matches"]
-            for match in matches:
-                channel_id = match["channel"]["id"]
-                channel_name = match["channel"]["name"]
-                permalink = match["permalink"]
-                text = match["text"]
-                ts = match["ts"]
-                search_type = match["type"]
-                search_message_list.append({
-                    "channel_id": channel_id,
-                    "channel_name": channel_name,
-                    "permalink": permalink,
-                    "text": text,
-                    "ts": ts,
-                    "type": search_type
-                })
-        else:
-            raise Exception(f"API request failed: {response['error']}")
-    return search_message_list
-
+    return get_slack_search(slack_user_client, config).search(query, channels)
@@ -0,0 +1,60 @@
+from collections import deque
+
+''' per thread conversation history with incremental token accounting '''
+
+# rough per turn overhead of the tuple, the strings and the deque slot, used for memory estimates
+TURN_OVERHEAD_BYTES = 200
+
+
+class ThreadHistory:
+    """
+    Question/answer pairs of a single thread, oldest first.
+
+    Each turn is stored together with its token count, which is computed once when the
+    turn is added, and a running total is kept so trimming to a token budget only drops
+    turns off the front instead of re-tokenizing the whole history. approx_bytes is a
+    running estimate of the memory the turns take.
+    """
+    __slots__ = ('turns', 'total_tokens', 'approx_bytes')
+
+    def __init__(self):
+        self.turns = deque()
+        self.total_tokens = 0
+        self.approx_bytes = 0
+
+    def append(self, question, answer, token_count, token_limit):
+        """
+        Add a turn and drop the oldest turns until the history fits in token_limit.
+        The newest turn is always kept, even if it is over the limit on its own.
+        """
+        self._push(question, answer, token_count)
+        while len(self.turns) > 1 and self.total_tokens > token_limit:
+            dropped_question, dropped_answer, dropped_tokens = self.turns.popleft()
+            self.total_tokens -= dropped_tokens
+            self.approx_bytes -= _turn_bytes(dropped_question, dropped_answer)
+
+    def _push(self, question, answer, token_count):
+        self.turns.append((question, answer, token_count))
+        self.total_tokens += token_count
+        self.approx_bytes += _turn_bytes(question, answer)
+
+    def as_chat_history(self):
+        # the (question, answer) list format ConversationalRetrievalChain expects
+        return [(question, answer) for question, answer, _ in self.turns]
+
+    def to_list(self):
+        return [list(turn) for turn in self.turns]
+
+    @classmethod
+    def from_list(cls, turns):
+        history = cls()
+        for question, answer, token_count in turns:
+            history._push(question, answer, token_count)
+        return history
+
+    def __len__(self):
+        return len(self.turns)
+
+
+def _turn_bytes(question, answer):
+    return len(question) + len(answer) + TURN_OVERHEAD_BYTES
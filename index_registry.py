@@ -0,0 +1,273 @@
+import os
+import time
+import pickle
+import logging
+from threading import Lock, Thread
+from collections import OrderedDict
+
+''' process-wide faiss index cache shared by every chat state '''
+
+logger = logging.getLogger(__name__)
+
+
+def get_vb_config(config, vb_name):
+    return next(vb for vb in config['vectordb'] if vb['vb_name'] == vb_name)
+
+
+def index_size_on_disk(faiss_path):
+    """
+    Approximate the in-memory size of a saved index by the size of its files on disk.
+
+    Args:
+        faiss_path (str): The directory written by FAISS.save_local.
+    Returns:
+        (int): The total size in bytes of the files in the directory.
+    """
+    if not os.path.isdir(faiss_path):
+        return 0
+    return sum(os.path.getsize(os.path.join(faiss_path, name)) for name in os.listdir(faiss_path))
+
+
+def load_faiss(vb_config, embeddings):
+    """
+    Load a saved FAISS index according to the load_mode of its vectordb entry.
+
+    load_mode "memory" (default) reads the whole index onto the heap. load_mode "mmap"
+    memory-maps the inverted lists of IVF indexes read-only so forked workers share the same
+    pages. faiss reads every other type (Flat, HNSW, IDMap2 wrapped) fully onto the heap even
+    with the mmap flag, so those are reported as loaded into memory.
+
+    Args:
+        vb_config (dict): The vectordb entry from config.yaml.
+        embeddings (Embeddings): The embedding used to embed queries against the index.
+    Returns:
+        (FAISS, bool): The vector store and whether it is memory-mapped.
+    """
+    from langchain.vectorstores import FAISS
+    faiss_path = vb_config['path']
+    if vb_config.get('load_mode', 'memory') == 'mmap':
+        import faiss
+        try:
+            index = faiss.read_index(os.path.join(faiss_path, 'index.faiss'),
+                                     faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            logger.warning(f"Could not memory-map {faiss_path}, loading into memory instead: {e}")
+        else:
+            mmapped = is_memory_mapped(index)
+            if not mmapped:
+                logger.warning(f"load_mode mmap only maps IVF indexes, {faiss_path} was loaded into memory")
+            with open(os.path.join(faiss_path, 'index.pkl'), 'rb') as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+            return FAISS(embeddings.embed_query, index, docstore, index_to_docstore_id), mmapped
+    return FAISS.load_local(faiss_path, embeddings), False
+
+
+def is_memory_mapped(index):
+    """ Whether index is an IVF index whose inverted lists faiss mapped from disk. """
+    import faiss
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return False
+    return isinstance(faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists)
+
+
+def apply_search_params(index, vb_config):
+    """
+    Set the search parameters of the search section of a vectordb entry on a loaded index:
+    nprobe for IVF indexes and ef_search for HNSW indexes.
+    """
+    search_config = vb_config.get('search') or {}
+    index_type = (vb_config.get('index') or {}).get('type', 'Flat')
+    params = {}
+    if index_type.startswith('IVF') and 'nprobe' in search_config:
+        params['nprobe'] = search_config['nprobe']
+    if index_type == 'HNSW' and 'ef_search' in search_config:
+        params['efSearch'] = search_config['ef_search']
+    if params:
+        import faiss
+        parameter_space = faiss.ParameterSpace()
+        for name, value in params.items():
+            parameter_space.set_index_parameter(index, name, value)
+
+
+def touch_index_pages(faiss_path, chunk_size=1 << 20):
+    # read the index file once so its pages are in the page cache before the first query
+    with open(os.path.join(faiss_path, 'index.faiss'), 'rb') as f:
+        while f.read(chunk_size):
+            pass
+
+
+class IndexRegistry:
+    """
+    Load each FAISS index once and share it across users.
+
+    Indexes are keyed by (vb_name, embedding name) and kept in least recently used order.
+    When max_indexes or max_bytes is exceeded the least recently used index is dropped;
+    a chain answering with it when that happens finishes its call.
+    Memory-mapped IVF indexes live in the shared page cache and don't count towards max_bytes.
+
+    The index pipeline publishes new versions by repointing the vectordb path, so every
+    reload_check_interval seconds a lookup checks where the path points and, if it moved,
+    loads the new version in the background and swaps it in. Until then, and for chains
+    already holding the old one, the previous version keeps serving.
+
+    Listeners added with add_eviction_listener are called with the vector store of every
+    evicted or replaced index, so caches holding it (the chain pool) can let go of it.
+    """
+    def __init__(self, max_indexes=None, max_bytes=None, reload_check_interval=30):
+        self.max_indexes = max_indexes
+        self.max_bytes = max_bytes
+        self.reload_check_interval = reload_check_interval
+        self._lock = Lock()
+        self._load_locks = {}
+        self._entries = OrderedDict()
+        self._reloading = set()
+        self._eviction_listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.reloads = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def get(self, lazy_embedding, config):
+        vb_name = lazy_embedding.config['vb_name']
+        key = (vb_name, lazy_embedding.config['name'])
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                entry = self._entries[key]
+                if self.reload_check_interval is not None and time.monotonic() - entry['checked_at'] > self.reload_check_interval:
+                    entry['checked_at'] = time.monotonic()
+                    self._check_version(key, entry, lazy_embedding, config)
+                return entry['db']
+            self.misses += 1
+            load_lock = self._load_locks.setdefault(key, Lock())
+
+        # load outside the registry lock so one slow index doesn't block the others
+        with load_lock:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]['db']
+            entry = self._load(key, lazy_embedding, config)
+            with self._lock:
+                self._entries[key] = entry
+                evicted = self._evict()
+            self._notify_evicted(evicted)
+        return entry['db']
+
+    def add_eviction_listener(self, listener):
+        """ Call listener(db) with the vector store of every index dropped or replaced from now on. """
+        with self._lock:
+            self._eviction_listeners.append(listener)
+
+    def _notify_evicted(self, dbs):
+        # called without the registry lock, listeners take their own locks
+        for db in dbs:
+            for listener in list(self._eviction_listeners):
+                try:
+                    listener(db)
+                except Exception:
+                    logger.exception("Index eviction listener failed")
+
+    def get_version(self, lazy_embedding):
+        """ The resolved path of the loaded index, changes when a new version is swapped in. """
+        with self._lock:
+            entry = self._entries.get((lazy_embedding.config['vb_name'], lazy_embedding.config['name']))
+            return entry['version'] if entry else None
+
+    def get_retriever(self, lazy_embedding, config):
+        search_config = get_vb_config(config, lazy_embedding.config['vb_name']).get('search') or {}
+        search_kwargs = {'k': search_config['k']} if 'k' in search_config else {}
+        return self.get(lazy_embedding, config).as_retriever(search_kwargs=search_kwargs)
+
+    def _load(self, key, lazy_embedding, config):
+        vb_config = get_vb_config(config, key[0])
+        version = os.path.realpath(vb_config['path'])
+        start = time.perf_counter()
+        # load from the resolved version so a publish during the load can't mix two versions
+        db, mmapped = load_faiss(dict(vb_config, path=version), lazy_embedding.embedding)
+        apply_search_params(db.index, vb_config)
+        elapsed = time.perf_counter() - start
+        size = 0 if mmapped else index_size_on_disk(version)
+        logger.info(f"Loaded index {key[0]} for {key[1]} from {version} in {elapsed:.2f}s "
+                    f"({'mmap' if mmapped else f'{size} bytes'})")
+        with self._lock:
+            self.loads += 1
+            self.load_seconds += elapsed
+        return {'db': db, 'size': size, 'version': version, 'checked_at': time.monotonic()}
+
+    def _check_version(self, key, entry, lazy_embedding, config):
+        # called with the registry lock held
+        version = os.path.realpath(get_vb_config(config, key[0])['path'])
+        if version == entry['version'] or key in self._reloading:
+            return
+        self._reloading.add(key)
+        Thread(target=self._reload, args=(key, lazy_embedding, config), name=f"reload-{key[0]}", daemon=True).start()
+
+    def _reload(self, key, lazy_embedding, config):
+        try:
+            entry = self._load(key, lazy_embedding, config)
+            evicted = []
+            with self._lock:
+                # the old index may have been evicted meanwhile, only swap it if it is still cached
+                if key in self._entries:
+                    evicted.append(self._entries[key]['db'])
+                    self._entries[key] = entry
+                    self.reloads += 1
+                    evicted += self._evict()
+            self._notify_evicted(evicted)
+            logger.info(f"Swapped in index {entry['version']} for {key[1]}")
+        except Exception:
+            logger.exception(f"Reloading index {key[0]} for {key[1]} failed, keeping the current version")
+        finally:
+            with self._lock:
+                self._reloading.discard(key)
+
+    def _evict(self):
+        # never evict the entry that was just loaded, returns the evicted stores to notify about
+        evicted = []
+        while len(self._entries) > 1 and self._over_budget():
+            key, entry = self._entries.popitem(last=False)
+            evicted.append(entry['db'])
+            self.evictions += 1
+            logger.info(f"Evicted index {key[0]} for {key[1]}")
+        return evicted
+
+    def _over_budget(self):
+        if self.max_indexes is not None and len(self._entries) > self.max_indexes:
+            return True
+        if self.max_bytes is not None and sum(entry['size'] for entry in self._entries.values()) > self.max_bytes:
+            return True
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "indexes": len(self._entries),
+                "bytes": sum(entry['size'] for entry in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+                "load_seconds": self.load_seconds,
+            }
+
+
+_index_registry = None
+_index_registry_lock = Lock()
+
+
+def get_index_registry(config):
+    global _index_registry
+    with _index_registry_lock:
+        if _index_registry is None:
+            cache_config = config.get('index_cache') or {}
+            _index_registry = IndexRegistry(max_indexes=cache_config.get('max_indexes'),
+                                            max_bytes=cache_config.get('max_bytes'),
+                                            reload_check_interval=cache_config.get('reload_check_interval', 30))
+    return _index_registry
@@ -0,0 +1,66 @@
+import sqlite3
+from slack_db import DB_PATH
+
+''' analytics queries over the conversations, turns and reactions tables '''
+
+
+def feedback_rates_by_model(db_path=DB_PATH):
+    """
+    Thumbs up/down counts and rates per model and embedding.
+
+    The planner reads turns through the (model_name, embedding_name) index and reactions
+    through the (turn_id, user_reaction) index, so neither table is scanned row by row.
+
+    Returns:
+        (list[dict]): One entry per model/embedding pair with turns, thumbs_up, thumbs_down,
+        feedback_rate (share of turns with any reaction) and positive_rate (share of positive reactions).
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute('''
+            SELECT t.model_name, t.embedding_name,
+                   COUNT(*) AS turns,
+                   SUM((SELECT COUNT(*) FROM reactions r WHERE r.turn_id = t.id AND r.user_reaction = '+1')) AS thumbs_up,
+                   SUM((SELECT COUNT(*) FROM reactions r WHERE r.turn_id = t.id AND r.user_reaction = '-1')) AS thumbs_down,
+                   SUM(EXISTS (SELECT 1 FROM reactions r WHERE r.turn_id = t.id)) AS turns_with_feedback
+            FROM turns t
+            GROUP BY t.model_name, t.embedding_name
+        ''').fetchall()
+    finally:
+        conn.close()
+    return [_feedback_row(*row) for row in rows]
+
+
+def feedback_rate(model_name, embedding_name=None, db_path=DB_PATH):
+    """
+    Feedback counts and rates for a single model, optionally narrowed to one embedding.
+    The model is looked up through the (model_name, embedding_name) index.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute('''
+            SELECT COUNT(*),
+                   SUM((SELECT COUNT(*) FROM reactions r WHERE r.turn_id = t.id AND r.user_reaction = '+1')),
+                   SUM((SELECT COUNT(*) FROM reactions r WHERE r.turn_id = t.id AND r.user_reaction = '-1')),
+                   SUM(EXISTS (SELECT 1 FROM reactions r WHERE r.turn_id = t.id))
+            FROM turns t
+            WHERE t.model_name = :model_name AND (:embedding_name IS NULL OR t.embedding_name = :embedding_name)
+        ''', {"model_name": model_name, "embedding_name": embedding_name}).fetchone()
+    finally:
+        conn.close()
+    return _feedback_row(model_name, embedding_name, *row)
+
+
+def _feedback_row(model_name, embedding_name, turns, thumbs_up, thumbs_down, turns_with_feedback):
+    thumbs_up = thumbs_up or 0
+    thumbs_down = thumbs_down or 0
+    reactions = thumbs_up + thumbs_down
+    return {
+        "model_name": model_name,
+        "embedding_name": embedding_name,
+        "turns": turns,
+        "thumbs_up": thumbs_up,
+        "thumbs_down": thumbs_down,
+        "feedback_rate": (turns_with_feedback or 0) / turns if turns else 0.0,
+        "positive_rate": thumbs_up / reactions if reactions else 0.0,
+    }
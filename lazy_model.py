@@ -1,42 +1,112 @@
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import HuggingFaceEmbeddings, OpenAIEmbeddings, HuggingFaceInstructEmbeddings
+from threading import Lock
 
 ''' lazy model and embeddings loading'''
 
+# langchain and transformers are imported when the first model, embedding or tokenizer is
+# loaded, not when the config is read, so the app starts serving without them
+
+# tokenizers are shared between models that use the same one
+_tokenizers = {}
+_tokenizers_lock = Lock()
+
+
+def get_tokenizer(name):
+    with _tokenizers_lock:
+        if name not in _tokenizers:
+            from transformers import AutoTokenizer
+            _tokenizers[name] = AutoTokenizer.from_pretrained(name)
+        return _tokenizers[name]
+
+
 class LazyModel:
     def __init__(self, config):
         self.config = config
         self._model = None
+        self._condense_model = None
+        self._lock = Lock()
 
     @property
     def model(self):
         if self._model is None:
-            # load model here based on self.config
-            if self.config['type'] == 'ChatOpenAI':
-                #self._model = ChatOpenAI(temperature=self.config['temperature'], model_name=self.config['model_name'])
-                model_kwargs = self.config.copy()
-                model_kwargs.pop('type', None)
-                model_kwargs.pop('name', None)
-                self._model = ChatOpenAI(**model_kwargs)
+            # models are shared across request threads, make sure only one of them loads it
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load_model()
         return self._model
 
+    @property
+    def tokenizer(self):
+        return get_tokenizer(self.config.get('tokenizer', 'gpt2'))
+
+    @property
+    def condense_model(self):
+        """
+        A non-streaming copy of the model for the question condensing step, so only the
+        answer is streamed. None if the model doesn't stream.
+        """
+        if not self.config.get('streaming'):
+            return None
+        if self._condense_model is None:
+            with self._lock:
+                if self._condense_model is None:
+                    self._condense_model = self._load_model(streaming=False)
+        return self._condense_model
+
+    def _load_model(self, **overrides):
+        # load model here based on self.config
+        if self.config['type'] == 'ChatOpenAI':
+            from langchain.chat_models import ChatOpenAI
+            #self._model = ChatOpenAI(temperature=self.config['temperature'], model_name=self.config['model_name'])
+            model_kwargs = self.config.copy()
+            model_kwargs.pop('type', None)
+            model_kwargs.pop('name', None)
+            model_kwargs.pop('tokenizer', None)
+            model_kwargs.pop('token_limit', None)
+            model_kwargs.pop('stream_interval_ms', None)
+            if model_kwargs.pop('dispatch', None) is not None:
+                # model_dispatch retries rate limits itself, honoring the retry headers
+                model_kwargs.setdefault('max_retries', 1)
+            model_kwargs.update(overrides)
+            return ChatOpenAI(**model_kwargs)
+
 
 class LazyEmbedding:
     def __init__(self, config):
         self.config = config
         self._embedding = None
+        self._lock = Lock()
 
     @property
     def embedding(self):
         if self._embedding is None:
-            if self.config['type'] == 'HuggingFaceInstructEmbeddings':
-                self._embedding = HuggingFaceInstructEmbeddings(
-                    embed_instruction=self.config.get('embed_instruction'),
-                    query_instruction=self.config.get('query_instruction')
-                )
-            elif self.config['type'] == 'OpenAIEmbeddings':
-                self._embedding = OpenAIEmbeddings()
-            elif self.config['type'] == 'HuggingFaceEmbeddings':
-                model_name = self.config.get('model_name')
-                self._embedding = HuggingFaceEmbeddings(model_name=model_name)
+            with self._lock:
+                if self._embedding is None:
+                    self._embedding = self._load_embedding()
         return self._embedding
+
+    def _load_embedding(self):
+        if self.config['type'] == 'HuggingFaceInstructEmbeddings':
+            from langchain.embeddings import HuggingFaceInstructEmbeddings
+            return HuggingFaceInstructEmbeddings(
+                embed_instruction=self.config.get('embed_instruction'),
+                query_instruction=self.config.get('query_instruction')
+            )
+        elif self.config['type'] == 'OpenAIEmbeddings':
+            from langchain.embeddings import OpenAIEmbeddings
+            return OpenAIEmbeddings()
+        elif self.config['type'] == 'HuggingFaceEmbeddings':
+            from langchain.embeddings import HuggingFaceEmbeddings
+            from embedding_batcher import BatchingEmbedding
+            model_name = self.config.get('model_name')
+            embedding = HuggingFaceEmbeddings(model_name=model_name)
+            batching = self.config.get('batching')
+            if batching:
+                # concurrent questions share one forward pass instead of running batches of one
+                return BatchingEmbedding(embedding, max_wait_ms=batching.get('max_wait_ms', 10),
+                                         max_batch_size=batching.get('max_batch_size', 32))
+            return embedding
+
+    def stats(self):
+        """ Batching stats of the embedding, empty until it is loaded or when it isn't batched. """
+        stats = getattr(self._embedding, 'stats', None)
+        return stats() if stats is not None else {}
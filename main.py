@@ -1,36 +1,119 @@
-from slack_db import setup_database
-from utils import load_config, setup_app
-from flask import Flask, request
+from flask import request, jsonify, Response
 from setup_app import setup_app
-from events_handler import *
-from transformers import AutoTokenizer
-
-setup_database()
-config, models, embeddings, available_models, available_embeddings = load_config()
-app, flask_app, handler, slack_client, bot_id, slack_user_token, slack_user_client, executor = setup_app()
-tokenizer = AutoTokenizer.from_pretrained("gpt2")
-
-# Attach event handlers
-app.event("message")(handle_message_events)
-app.event("app_mention")(handle_mentions)
-app.event("reaction_added")(handle_reaction)
-app.command("/safety_mode")(activate_safety_mode)
-
-@flask_app.route("/slack/events", methods=["POST"])
-def slack_events():
+from slack_db import setup_database, start_interaction_logger
+from events_handler import handle_message_events, handle_mentions, handle_reaction, activate_safety_mode, periodic_cleanup
+from warmup import start_warmup
+from mention_queue import MentionDispatcher, REJECTED
+from chat_state_store import init_chat_state_store
+from metrics import registry as metrics_registry
+from index_registry import get_index_registry
+from answer_cache import get_answer_cache
+from slack_search import slack_search_stats
+from chatbot import chain_pool
+from model_dispatch import init_model_dispatcher
+
+'''
+entry point of the bot, create_app() builds it:
+    python main.py
+    gunicorn "main:create_app()"
+'''
+
+
+def create_app(config_file="config.yaml"):
     """
-    Route for handling Slack events.
-    This function passes the incoming HTTP request to the SlackRequestHandler for processing.
+    Build the bot and return its Flask app.
 
+    Nothing here waits on the network or loads a model: auth.test, the tokenizers, nltk's data
+    and the indexes are loaded by the background warm-up (or on first use when it is disabled),
+    and /healthz reports 503 until the warm-up is done.
+
+    Args:
+        config_file (str): The config to load, see config.yaml.
     Returns:
-        Response: The result of handling the request.
+        (Flask): The app serving /slack/events, /healthz and /metrics.
     """
-    return handler.handle(request)
+    setup_database()
+    app, flask_app, handler, bot = setup_app(config_file)
+    config = bot.config
+    bot.interaction_logger = start_interaction_logger(**(config.get('interaction_log') or {}))
+    bot.chat_state_store = init_chat_state_store(config)
+    queue_config = config.get('mention_queue') or {}
+    bot.mention_dispatcher = MentionDispatcher(bot.executor,
+                                               max_depth=queue_config.get('max_depth', 100),
+                                               dedup_ttl=queue_config.get('dedup_ttl', 600))
+    bot.model_dispatcher = init_model_dispatcher(bot.models)
+    bot.warmup = start_warmup(config, bot.embeddings, bot.models, tasks={"slack auth.test": lambda: bot.bot_id})
 
+    # pooled chains hold their index, drop them with it so the index cache budget frees memory
+    get_index_registry(config).add_eviction_listener(chain_pool.drop_index)
 
-periodic_cleanup()
+    # component stats are read when /metrics is scraped, the request path only records its traces
+    metrics_registry.register_collector('mention_queue', bot.mention_dispatcher.stats)
+    metrics_registry.register_collector('interaction_log', bot.interaction_logger.stats)
+    metrics_registry.register_collector('chat_state', bot.chat_state_store.stats)
+    metrics_registry.register_collector('chain_pool', chain_pool.stats)
+    metrics_registry.register_collector('index_registry', lambda: get_index_registry(config).stats())
+    answer_cache = get_answer_cache(config)
+    if answer_cache is not None:
+        metrics_registry.register_collector('answer_cache', answer_cache.stats)
+    metrics_registry.register_collector('slack_search', slack_search_stats)
+    for embedding_name, lazy_embedding in bot.embeddings.items():
+        metrics_registry.register_collector(f'embedding_batcher_{embedding_name}', lazy_embedding.stats)
+    for model_name in bot.models:
+        metrics_registry.register_collector(f'model_dispatch_{model_name}',
+                                            lambda model_name=model_name: bot.model_dispatcher.stats(model_name))
 
+    def enqueue_mention(ack, body, say, logger):
+        """
+        Ack the mention right away and answer it on the worker pool, so Slack doesn't retry
+        the event while the LLM is working.
+        """
+        ack()
+        event = body["event"]
+        result = bot.mention_dispatcher.submit(body.get("event_id"), event["user"],
+                                               lambda: handle_mentions(body, say, logger))
+        if result == REJECTED:
+            logger.warning(f"Mention queue full, rejected event {body.get('event_id')}")
+            say(text="I'm answering a lot of questions right now, please try again in a minute.",
+                thread_ts=event["ts"])
 
-if __name__ == "__main__":
-    flask_app.run(debug=True, port=5002)
+    # Attach event handlers
+    app.event("message")(handle_message_events)
+    app.event("app_mention")(enqueue_mention)
+    app.event("reaction_added")(handle_reaction)
+    app.command("/safety_mode")(activate_safety_mode)
+
+    @flask_app.route("/slack/events", methods=["POST"])
+    def slack_events():
+        """
+        Route for handling Slack events.
+        This function passes the incoming HTTP request to the SlackRequestHandler for processing.
 
+        Returns:
+            Response: The result of handling the request.
+        """
+        return handler.handle(request)
+
+    @flask_app.route("/healthz", methods=["GET"])
+    def healthz():
+        """
+        Route for readiness checks.
+        Returns 200 once the startup warm-up has finished and 503 while it is still running or has failed.
+        """
+        return jsonify(bot.warmup.health()), 200 if bot.warmup.is_ready() else 503
+
+    @flask_app.route("/metrics", methods=["GET"])
+    def metrics():
+        """
+        Route for Prometheus scrapes.
+        Returns the per stage latency histograms (with p50/p95/p99 estimates) by model and embedding,
+        token and cache counters, and the stats of the queue, caches and stores as gauges.
+        """
+        return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
+
+    periodic_cleanup()
+    return flask_app
+
+
+if __name__ == "__main__":
+    create_app().run(debug=True, port=5002)
@@ -0,0 +1,113 @@
+import time
+import logging
+from threading import Lock
+from collections import deque, OrderedDict
+
+''' bounded queue running mentions off the request thread, in order per user '''
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+DUPLICATE = "duplicate"
+REJECTED = "rejected"
+
+
+class MentionDispatcher:
+    """
+    Run mention jobs on an executor after the event has been acked.
+
+    Jobs of the same user run one after another in the order they arrived, jobs of
+    different users run concurrently. At most max_depth jobs wait at any time, further
+    submissions are rejected so the caller can tell the user to try again. Slack retries
+    carry the event_id of the original delivery, so any event_id seen in the last
+    dedup_ttl seconds is dropped.
+    """
+    def __init__(self, executor, max_depth=100, dedup_ttl=600):
+        self.executor = executor
+        self.max_depth = max_depth
+        self.dedup_ttl = dedup_ttl
+        self._lock = Lock()
+        self._user_queues = {}
+        self._seen_events = OrderedDict()
+        self.depth = 0
+        self.started = 0
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, event_id, user_id, job):
+        """
+        Queue job for user_id.
+
+        Args:
+            event_id (str): The Slack event_id, used to drop retried deliveries.
+            user_id (str): Jobs with the same user_id run in submission order.
+            job (callable): Called without arguments on a worker thread.
+        Returns:
+            (str): QUEUED, DUPLICATE or REJECTED.
+        """
+        now = time.time()
+        with self._lock:
+            self._expire_seen(now)
+            if event_id is not None and event_id in self._seen_events:
+                self.duplicates += 1
+                return DUPLICATE
+            if self.depth >= self.max_depth:
+                self.rejected += 1
+                return REJECTED
+            if event_id is not None:
+                self._seen_events[event_id] = now
+            self.depth += 1
+            user_queue = self._user_queues.get(user_id)
+            if user_queue is not None:
+                # a worker is already draining this user's queue, it will pick the job up
+                user_queue.append((job, now))
+                return QUEUED
+            self._user_queues[user_id] = deque([(job, now)])
+        self.executor.submit(self._drain, user_id)
+        return QUEUED
+
+    def _drain(self, user_id):
+        while True:
+            with self._lock:
+                user_queue = self._user_queues[user_id]
+                if not user_queue:
+                    del self._user_queues[user_id]
+                    return
+                job, queued_at = user_queue.popleft()
+                self.depth -= 1
+                self.started += 1
+                wait = time.time() - queued_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                job()
+                with self._lock:
+                    self.processed += 1
+            except Exception:
+                logger.exception(f"Mention job failed for user {user_id}")
+                with self._lock:
+                    self.failed += 1
+
+    def _expire_seen(self, now):
+        while self._seen_events:
+            event_id, seen_at = next(iter(self._seen_events.items()))
+            if now - seen_at <= self.dedup_ttl:
+                break
+            self._seen_events.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "depth": self.depth,
+                "active_users": len(self._user_queues),
+                "processed": self.processed,
+                "failed": self.failed,
+                "duplicates": self.duplicates,
+                "rejected": self.rejected,
+                "avg_wait_seconds": self.total_wait / self.started if self.started else 0.0,
+                "max_wait_seconds": self.max_wait,
+            }
@@ -0,0 +1,167 @@
+import re
+import math
+import logging
+from threading import Lock
+
+''' in-process metrics rendered in the prometheus text format '''
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    items = list(label_key) + list(extra)
+    if not items:
+        return ''
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for name, value in items)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Histogram:
+    """
+    Cumulative histogram per label set. Besides the _bucket/_sum/_count series it renders
+    p50/p95/p99 estimates, interpolated within buckets the way histogram_quantile does.
+    """
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def quantile(self, q, **labels):
+        with self._lock:
+            series = self._series.get(_label_key(labels))
+            return self._quantile(series, q) if series else math.nan
+
+    def _quantile(self, series, q):
+        rank = q * series["count"]
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets + (math.inf,), series["counts"]):
+            if cumulative + count >= rank and count:
+                if bound == math.inf:
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return lower
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        quantile_lines = []
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (math.inf,), series["counts"]):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else repr(bound)
+                    lines.append(f'{self.name}_bucket{_format_labels(key, [("le", le)])} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {series["sum"]}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {series["count"]}')
+                for q in QUANTILES:
+                    quantile_lines.append(f'{self.name}_quantile{_format_labels(key, [("quantile", q)])} '
+                                          f'{self._quantile(series, q)}')
+        if quantile_lines:
+            lines += [f'# HELP {self.name}_quantile Quantile estimates of {self.name}',
+                      f'# TYPE {self.name}_quantile gauge'] + quantile_lines
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._lock = Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            lines += [f'{self.name}{_format_labels(key)} {value}' for key, value in sorted(self._values.items())]
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Histograms and counters recorded by the request path, plus collectors: functions returning
+    the stats() dict of a component (queue, caches, stores), rendered as gauges at scrape time.
+    """
+    def __init__(self, prefix='slackbot'):
+        self.prefix = prefix
+        self._lock = Lock()
+        self._metrics = {}
+        self._collectors = {}
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(name, lambda full_name: Histogram(full_name, help_text, buckets))
+
+    def counter(self, name, help_text):
+        return self._get_or_create(name, lambda full_name: Counter(full_name, help_text))
+
+    def _get_or_create(self, name, factory):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory(f'{self.prefix}_{name}')
+            return self._metrics[name]
+
+    def register_collector(self, name, collect):
+        name = re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        with self._lock:
+            self._collectors[name] = collect
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors.items())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        for name, collect in collectors:
+            try:
+                stats = collect() or {}
+            except Exception:
+                logger.exception(f"Collecting {name} metrics failed")
+                continue
+            lines += self._render_stats(name, stats)
+        return '\n'.join(lines) + '\n'
+
+    def _render_stats(self, name, stats):
+        # numbers become gauges, dicts of numbers become one gauge labelled by key, anything else is skipped
+        lines = []
+        for key, value in stats.items():
+            metric_name = f'{self.prefix}_{name}_{key}'
+            if isinstance(value, bool) or isinstance(value, (int, float)):
+                lines += [f'# TYPE {metric_name} gauge', f'{metric_name} {float(value)}']
+            elif isinstance(value, dict):
+                numeric = [(k, v) for k, v in value.items() if isinstance(v, (int, float))]
+                if numeric:
+                    lines.append(f'# TYPE {metric_name} gauge')
+                    lines += [f'{metric_name}{_format_labels([("key", k)])} {float(v)}' for k, v in numeric]
+        return lines
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,308 @@
+import re
+import math
+import time
+import random
+import logging
+from threading import Condition, Lock
+from collections import deque
+from email.utils import parsedate_to_datetime
+from metrics import registry
+from tracing import current_trace
+
+''' per model concurrency and token budgets, retries and fallback routing for the chat models '''
+
+logger = logging.getLogger(__name__)
+
+queue_wait_seconds = registry.histogram('model_queue_wait_seconds', 'Time LLM calls waited for their model, by model')
+fallbacks_total = registry.counter('model_fallbacks_total', 'LLM calls routed to the fallback model, by model and fallback')
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# openai 0.x and 1.x names of errors worth retrying that carry no status code
+RETRYABLE_ERRORS = ('Timeout', 'APITimeoutError', 'APIConnectionError', 'ServiceUnavailableError', 'TryAgain')
+# estimated tokens per character of prompt, for the token budget before the real usage is known
+TOKENS_PER_CHAR = 0.25
+
+
+class ModelLimiter:
+    """
+    In-flight and tokens-per-minute limits of one model.
+
+    acquire() waits until fewer than max_in_flight calls are running and the tokens used in
+    the last minute leave room for the call's estimate, which is reserved right away.
+    release() frees the slot and corrects the reservation with the tokens actually used.
+    A call bigger than the whole budget still runs once the window is empty.
+    """
+    def __init__(self, name, max_in_flight=None, tokens_per_minute=None):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self._cond = Condition()
+        self._usage = deque()
+        self.window_tokens = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.calls = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.fallbacks = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, tokens, timeout=None):
+        """
+        Wait for a slot and room for tokens.
+
+        Args:
+            tokens (int): The estimated tokens of the call.
+            timeout (float): Seconds to wait at most, None to wait as long as it takes.
+        Returns:
+            (float): The seconds waited, or None if timeout passed first.
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._wait_needed(tokens, now)
+                    if wait == 0:
+                        break
+                    if deadline is not None:
+                        if now >= deadline:
+                            self.timeouts += 1
+                            return None
+                        wait = min(wait, deadline - now)
+                    self._cond.wait(None if wait == math.inf else wait)
+                self.in_flight += 1
+                self._add_usage(now, tokens)
+            finally:
+                self.waiting -= 1
+            waited = time.monotonic() - start
+            self.calls += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def release(self, estimated_tokens, used_tokens=None):
+        with self._cond:
+            self.in_flight -= 1
+            if used_tokens is not None and used_tokens != estimated_tokens:
+                self._add_usage(time.monotonic(), used_tokens - estimated_tokens)
+            self._cond.notify_all()
+
+    def record_fallback(self):
+        with self._cond:
+            self.fallbacks += 1
+
+    def record_retry(self, status):
+        with self._cond:
+            self.retries += 1
+            if status == 429:
+                self.rate_limited += 1
+
+    def record_failure(self):
+        with self._cond:
+            self.failures += 1
+
+    def _wait_needed(self, tokens, now):
+        # called with the lock held, 0 when the call can start, math.inf to wait for a release
+        self._expire(now)
+        if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+            return math.inf
+        if (self.tokens_per_minute is not None and self.window_tokens > 0
+                and self.window_tokens + tokens > self.tokens_per_minute):
+            # usage leaves the window oldest first
+            return max(self._usage[0][0] + 60 - now, 0.001)
+        return 0
+
+    def _add_usage(self, now, tokens):
+        self._usage.append((now, tokens))
+        self.window_tokens += tokens
+
+    def _expire(self, now):
+        while self._usage and self._usage[0][0] <= now - 60:
+            self.window_tokens -= self._usage.popleft()[1]
+
+    def stats(self):
+        with self._cond:
+            self._expire(time.monotonic())
+            return {
+                "in_flight": self.in_flight,
+                "queue_depth": self.waiting,
+                "tokens_last_minute": self.window_tokens,
+                "calls": self.calls,
+                "timeouts": self.timeouts,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "failures": self.failures,
+                "fallbacks": self.fallbacks,
+                "avg_wait_seconds": self.total_wait / self.calls if self.calls else 0.0,
+                "max_wait_seconds": self.max_wait,
+            }
+
+
+class ModelDispatcher:
+    """
+    Run the LLM calls of the models with a dispatch section in config.yaml under its limits.
+
+    A call waits for its model's ModelLimiter. If the model has a fallback and the wait passes
+    queue_slo_ms, the call goes to the fallback model instead (only one hop). Rate limits,
+    timeouts and 5xx errors are retried up to max_retries times, after the delay the response's
+    retry headers ask for or, without them, a full-jitter exponential backoff from
+    backoff_base_ms capped at backoff_max_ms.
+    """
+    def __init__(self, models):
+        self.models = models
+        self._limiters = {}
+        for name, lazy_model in models.items():
+            dispatch_config = lazy_model.config.get('dispatch') or {}
+            self._limiters[name] = ModelLimiter(name, max_in_flight=dispatch_config.get('max_in_flight'),
+                                                tokens_per_minute=dispatch_config.get('tokens_per_minute'))
+
+    def wrap(self, lazy_model, condense=False):
+        """
+        The chat model for the answer or the condense step of lazy_model's chains: one running its
+        calls through the dispatcher, or the model itself when it has no dispatch section.
+        """
+        if lazy_model.config.get('dispatch') is None:
+            return lazy_model.condense_model if condense else lazy_model.model
+        from dispatched_chat_model import DispatchedChatModel
+        return DispatchedChatModel(dispatcher=self, model_name=lazy_model.config['name'], condense=condense)
+
+    def generate(self, model_name, condense, prompt_chars, generate):
+        """
+        Call generate(model) with a model of model_name, or of its fallback.
+
+        Args:
+            model_name (str): The model the chain was built for.
+            condense (bool): Whether this is the question condensing step, which never streams.
+            prompt_chars (int): The size of the prompt, to estimate its tokens.
+            generate (callable): Makes the call given the chat model to use.
+        Returns:
+            (ChatResult): What generate returned.
+        """
+        dispatch_config = self.models[model_name].config.get('dispatch') or {}
+        tokens = int(prompt_chars * TOKENS_PER_CHAR) + dispatch_config.get('expected_completion_tokens', 256)
+        limiter = self._limiters[model_name]
+        fallback = dispatch_config.get('fallback')
+        slo_ms = dispatch_config.get('queue_slo_ms')
+        can_fall_back = fallback in self.models and fallback != model_name and slo_ms is not None
+        waited = limiter.acquire(tokens, timeout=slo_ms / 1000 if can_fall_back else None)
+        if waited is None:
+            logger.warning(f"{model_name} waited longer than {slo_ms} ms, routing the call to {fallback}")
+            limiter.record_fallback()
+            fallbacks_total.inc(model=model_name, fallback=fallback)
+            current_trace().set("fallback_model", fallback)
+            limiter = self._limiters[fallback]
+            waited = slo_ms / 1000 + limiter.acquire(tokens)
+            dispatch_config = self.models[fallback].config.get('dispatch') or {}
+        queue_wait_seconds.observe(waited, model=model_name)
+        current_trace().add_stage("model_queue", waited)
+
+        lazy_model = self.models[limiter.name]
+        # the condense step must not stream its tokens into the slack reply
+        model = (lazy_model.condense_model or lazy_model.model) if condense else lazy_model.model
+        used_tokens = None
+        try:
+            result = self._with_retries(limiter, dispatch_config, lambda: generate(model))
+            used_tokens = ((result.llm_output or {}).get('token_usage') or {}).get('total_tokens')
+            return result
+        finally:
+            limiter.release(tokens, used_tokens)
+
+    def _with_retries(self, limiter, dispatch_config, call):
+        max_retries = dispatch_config.get('max_retries', 3)
+        base = dispatch_config.get('backoff_base_ms', 500) / 1000
+        cap = dispatch_config.get('backoff_max_ms', 20000) / 1000
+        for attempt in range(max_retries + 1):
+            try:
+                return call()
+            except Exception as e:
+                status = error_status(e)
+                if attempt == max_retries or not is_retryable(e):
+                    limiter.record_failure()
+                    raise
+                delay = retry_delay(e, attempt, base, cap)
+                limiter.record_retry(status)
+                current_trace().incr("llm_retries")
+                logger.warning(f"{limiter.name} call failed ({status or type(e).__name__}), "
+                               f"retry {attempt + 1}/{max_retries} in {delay:.2f}s")
+                time.sleep(delay)
+
+    def stats(self, model_name):
+        return self._limiters[model_name].stats()
+
+
+def error_status(error):
+    # openai 0.x sets http_status, openai 1.x status_code
+    return getattr(error, 'http_status', None) or getattr(error, 'status_code', None)
+
+
+def is_retryable(error):
+    return error_status(error) in RETRYABLE_STATUS or type(error).__name__ in RETRYABLE_ERRORS
+
+
+def retry_delay(error, attempt, base, cap):
+    """
+    Seconds to wait before retrying: what the error's retry headers ask for plus a little jitter,
+    or a full-jitter exponential backoff when there are none.
+    """
+    delay = header_delay(error)
+    if delay is not None:
+        return min(delay, cap) + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def header_delay(error):
+    headers = getattr(error, 'headers', None)
+    if headers is None:
+        headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    headers = {key.lower(): value for key, value in headers.items()}
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if 'retry-after' in headers:
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(headers['retry-after']).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    resets = [parse_duration(headers[name]) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')
+              if name in headers]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def parse_duration(value):
+    """ Parse OpenAI's reset durations like "20ms", "1.5s" or "6m0s" into seconds. """
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value)
+    if not parts:
+        return None
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+model_dispatcher = None
+_model_dispatcher_lock = Lock()
+
+
+def init_model_dispatcher(models):
+    """ Create the dispatcher of the lazy models loaded from config.yaml. """
+    global model_dispatcher
+    with _model_dispatcher_lock:
+        model_dispatcher = ModelDispatcher(models)
+    return model_dispatcher
+
+
+def get_model_dispatcher():
+    """ The dispatcher created by init_model_dispatcher, None if models are called directly. """
+    return model_dispatcher
@@ -2,6 +2,7 @@ import os
 import yaml
 #import asyncio
 import logging
+from threading import Lock
 from flask import Flask
 from concurrent.futures import ThreadPoolExecutor
 from slack_bolt import App
@@ -11,7 +12,60 @@ from slack_bolt.adapter.flask import SlackRequestHandler
 from lazy_model import LazyModel, LazyEmbedding
 
 
-def setup_app():
+class BotContext:
+    """
+    Everything the event handlers share: the config, the lazy models and embeddings, the Slack
+    clients and the background services main.create_app starts.
+
+    The bot's user id comes from auth.test on first use (or from the startup warm-up), so
+    building the app doesn't wait on the network.
+    """
+    def __init__(self, config, models, embeddings, available_models, available_embeddings,
+                 slack_client, slack_user_client, executor):
+        self.config = config
+        self.models = models
+        self.embeddings = embeddings
+        self.available_models = available_models
+        self.available_embeddings = available_embeddings
+        self.slack_client = slack_client
+        self.slack_user_client = slack_user_client
+        self.executor = executor
+        self.interaction_logger = None
+        self.chat_state_store = None
+        self.mention_dispatcher = None
+        self.model_dispatcher = None
+        self.warmup = None
+        self._bot_id = None
+        self._lock = Lock()
+
+    @property
+    def bot_id(self):
+        if self._bot_id is None:
+            with self._lock:
+                if self._bot_id is None:
+                    self._bot_id = self.slack_client.api_call("auth.test")["user_id"]
+        return self._bot_id
+
+
+bot = None
+
+
+def get_bot():
+    """ The BotContext of the app built by setup_app. """
+    return bot
+
+
+def setup_app(config_file="config.yaml"):
+    """
+    Build the Slack and Flask apps and the BotContext without any network calls.
+
+    Args:
+        config_file (str): The config to load, see config.yaml.
+    Returns:
+        (App, Flask, SlackRequestHandler, BotContext): The Bolt app, the Flask app, the handler
+            passing Flask requests to Bolt and the context shared by the event handlers.
+    """
+    global bot
     # Load environment variables from .env file
     load_dotenv(find_dotenv())
 
@@ -19,22 +73,28 @@ def setup_app():
     slack_bot_token = os.environ["SLACK_BOT_TOKEN"]
     slack_signing_secret = os.environ["SLACK_SIGNING_SECRET"]
     slack_user_token = os.environ["SLACK_USER_TOKEN"]
+    # SLACK_API_URL points every client at another Web API endpoint, e.g. the fake server of the benchmarks
+    slack_api_url = os.environ.get("SLACK_API_URL", WebClient.BASE_URL)
+
+    config, models, embeddings, available_models, available_embeddings = load_config(config_file)
+
+    # Initialize the Slack app with the bot token. token_verification_enabled=False skips the
+    # auth.test call here: the token is checked by the warm-up's auth.test when it is enabled
+    # (a bad token fails /healthz) and by Bolt's authorization on the first event.
+    app = App(token=slack_bot_token, signing_secret=slack_signing_secret, token_verification_enabled=False)
 
-    # Initialize the Slack app
-    app = App(token=slack_bot_token)
+    # Initialize the Slack clients, the bot client is the one Bolt created with the token
+    slack_client = app.client
+    slack_client.base_url = slack_api_url
+    slack_user_client = WebClient(token=slack_user_token, base_url=slack_api_url)
 
     # Initialize the Flask app
     flask_app = Flask(__name__)
     handler = SlackRequestHandler(app)
 
-    # Initialize the Slack client
-    slack_client = WebClient(token=slack_bot_token)
-    bot_id = slack_client.api_call("auth.test")["user_id"]
-    slack_user_client = WebClient(token=slack_user_token)
+    # Initialize executor, mentions are answered on it after the event is acked
+    executor = ThreadPoolExecutor(max_workers=(config.get('mention_queue') or {}).get('max_workers'))
 
-    # Initialize executor
-    executor = ThreadPoolExecutor()
-    
     logging.basicConfig(
     level=logging.INFO,  # This will log all levels from DEBUG and above.
     format='%(asctime)s [%(levelname)s] - %(message)s',
@@ -44,7 +104,9 @@ def setup_app():
         ]
     )
 
-    return app, flask_app, handler, slack_client, bot_id, slack_user_token, slack_user_client, executor
+    bot = BotContext(config, models, embeddings, available_models, available_embeddings,
+                     slack_client, slack_user_client, executor)
+    return app, flask_app, handler, bot
 
 
 
@@ -66,4 +128,4 @@ def load_config(file_name="config.yaml"):
     available_models = [model["name"] for model in config["models"]]
     available_embeddings = [embedding["name"] for embedding in config["embeddings"]]
 
-    return config, models, embeddings, available_models, available_embeddings
\ No newline at end of file
+    return config, models, embeddings, available_models, available_embeddings
\ No newline at end of file
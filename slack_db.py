@@ -1,37 +1,255 @@
+import json
+import time
+import queue
+import atexit
 import sqlite3
+import logging
+from threading import Thread, Lock
 
-def setup_database():
-    conn = sqlite3.connect('slackbot.db')  
-    c = conn.cursor()
+DB_PATH = 'slackbot.db'
+SCHEMA_VERSION = 1
 
-    # Create table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS interactions
-        (user_id text, session_type text, model_name text, embedding_name text, user_question text, user_question_ts text, bot_response text, bot_response_ts text, user_reaction text, user_reaction_ts text, formatted_sources text, history text)
-    ''')
+logger = logging.getLogger(__name__)
 
-    conn.commit()  
-    conn.close()  
+# conversations are keyed by (channel_id, thread_ts). Each turn stores its question and answer
+# once, plus history_length: the number of turns of history sent with the question, not counting
+# the turn itself. Histories are kept per user, so these are the user's last history_length turns
+# before this one in the conversation. Rebuilding it has to filter the conversation's turns by
+# user_id, as other users in the same thread have their own histories.
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS conversations
+    (id integer PRIMARY KEY, channel_id text, thread_ts text, user_id text,
+     UNIQUE (channel_id, thread_ts));
+    CREATE TABLE IF NOT EXISTS turns
+    (id integer PRIMARY KEY, conversation_id integer REFERENCES conversations (id), user_id text,
+     model_name text, embedding_name text, user_question text, user_question_ts text, bot_response text,
+     bot_response_ts text, formatted_sources text, history_length integer);
+    CREATE TABLE IF NOT EXISTS reactions
+    (id integer PRIMARY KEY, turn_id integer REFERENCES turns (id), channel_id text, bot_response_ts text,
+     user_id text, user_reaction text, user_reaction_ts text);
+    CREATE INDEX IF NOT EXISTS conversations_user_id ON conversations (user_id);
+    CREATE INDEX IF NOT EXISTS turns_conversation_id ON turns (conversation_id);
+    CREATE INDEX IF NOT EXISTS turns_user_id ON turns (user_id);
+    CREATE INDEX IF NOT EXISTS turns_bot_response_ts ON turns (bot_response_ts);
+    CREATE INDEX IF NOT EXISTS turns_model_embedding ON turns (model_name, embedding_name);
+    CREATE INDEX IF NOT EXISTS reactions_turn_id ON reactions (turn_id, user_reaction);
+    CREATE INDEX IF NOT EXISTS reactions_bot_response_ts ON reactions (bot_response_ts);
+    CREATE INDEX IF NOT EXISTS reactions_user_id ON reactions (user_id);
+'''
 
-def record_interaction_in_database(user_id, 
-                                   session_type, 
-                                   model_name=None, 
-                                   embedding_name=None, 
+def setup_database(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path)
+    migrate(conn)
+    conn.close()
+
+
+def migrate(conn):
+    """
+    Bring the database up to SCHEMA_VERSION, tracked in PRAGMA user_version.
+
+    Version 1 replaces the flat interactions table with conversations, turns and reactions.
+    Rows of an existing interactions table are copied over once and the table is kept
+    as it is. Legacy rows have no channel or thread, so every legacy turn becomes its own
+    conversation with an empty channel_id. Tables and indexes missing from an up-to-date
+    database are created again.
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        # indexes added to SCHEMA after a database was migrated are created here
+        conn.executescript(SCHEMA)
+        return
+    with conn:
+        conn.executescript(SCHEMA)
+        legacy = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'interactions'").fetchone()
+        if legacy:
+            _copy_legacy_interactions(conn)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+def _copy_legacy_interactions(conn):
+    mentions = []
+    reactions = []
+    for row in conn.execute('SELECT * FROM interactions'):
+        (user_id, session_type, model_name, embedding_name, user_question, user_question_ts, bot_response,
+         bot_response_ts, user_reaction, user_reaction_ts, formatted_sources, history) = row
+        if session_type == 'reaction':
+            reactions.append(dict(user_id=user_id, channel_id=None, user_reaction=user_reaction, bot_response_ts=bot_response_ts,
+                                  user_reaction_ts=user_reaction_ts))
+        else:
+            mentions.append(dict(user_id=user_id, channel_id='', thread_ts=user_question_ts, model_name=model_name,
+                                 embedding_name=embedding_name, user_question=user_question,
+                                 user_question_ts=user_question_ts, bot_response=bot_response,
+                                 bot_response_ts=bot_response_ts, formatted_sources=formatted_sources,
+                                 history_length=len(json.loads(history)) if history else 0))
+    _insert_mentions(conn, mentions)
+    _insert_reactions(conn, reactions)
+
+
+def _insert_mentions(conn, rows):
+    conn.executemany('''
+        INSERT OR IGNORE INTO conversations (channel_id, thread_ts, user_id)
+        VALUES (:channel_id, :thread_ts, :user_id)
+    ''', rows)
+    conn.executemany('''
+        INSERT INTO turns (conversation_id, user_id, model_name, embedding_name, user_question, user_question_ts, bot_response, bot_response_ts, formatted_sources, history_length)
+        VALUES ((SELECT id FROM conversations WHERE channel_id = :channel_id AND thread_ts = :thread_ts),
+                :user_id, :model_name, :embedding_name, :user_question, :user_question_ts, :bot_response, :bot_response_ts, :formatted_sources, :history_length)
+    ''', rows)
+
+
+def _insert_reactions(conn, rows):
+    # turn_id stays null if the reacted message isn't a logged bot response
+    conn.executemany('''
+        INSERT INTO reactions (turn_id, channel_id, bot_response_ts, user_id, user_reaction, user_reaction_ts)
+        VALUES ((SELECT id FROM turns WHERE bot_response_ts = :bot_response_ts ORDER BY id DESC LIMIT 1),
+                :channel_id, :bot_response_ts, :user_id, :user_reaction, :user_reaction_ts)
+    ''', rows)
+
+
+def write_interactions(conn, rows):
+    """
+    Write a batch of interaction rows in a single transaction.
+    Mentions are written before reactions so a reaction can find a turn from the same batch.
+    """
+    with conn:
+        _insert_mentions(conn, [row for row in rows if row['session_type'] != 'reaction'])
+        _insert_reactions(conn, [row for row in rows if row['session_type'] == 'reaction'])
+
+
+class InteractionLogger:
+    """
+    Write interaction rows from a background thread.
+
+    Callers only put rows on an in-memory queue. The writer owns a single WAL-mode
+    connection and inserts rows with executemany, one transaction per batch, whenever
+    batch_size rows are waiting or flush_interval seconds have passed since the first
+    waiting row. close() writes whatever is left before returning.
+    """
+    def __init__(self, db_path=DB_PATH, batch_size=50, flush_interval=1.0):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._stop = object()
+        self._stats_lock = Lock()
+        self.rows_written = 0
+        self.batches = 0
+        self.failed_rows = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self._thread = Thread(target=self._run, name="interaction-logger", daemon=True)
+        self._thread.start()
+
+    def record(self, row):
+        self._queue.put(row)
+
+    def close(self, timeout=10):
+        self._queue.put(self._stop)
+        self._thread.join(timeout)
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        stopping = False
+        while not stopping:
+            row = self._queue.get()
+            if row is self._stop:
+                break
+            batch = [row]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is self._stop:
+                    stopping = True
+                    break
+                batch.append(row)
+            self._flush(conn, batch)
+        # drain rows that were queued behind the stop marker
+        leftover = []
+        while not self._queue.empty():
+            row = self._queue.get_nowait()
+            if row is not self._stop:
+                leftover.append(row)
+        if leftover:
+            self._flush(conn, leftover)
+        conn.close()
+
+    def _flush(self, conn, batch):
+        start = time.perf_counter()
+        try:
+            write_interactions(conn, batch)
+        except sqlite3.Error:
+            logger.exception(f"Failed to write {len(batch)} interaction rows")
+            with self._stats_lock:
+                self.failed_rows += len(batch)
+            return
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.rows_written += len(batch)
+            self.batches += 1
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "rows_written": self.rows_written,
+                "batches": self.batches,
+                "failed_rows": self.failed_rows,
+                "last_flush_seconds": self.last_flush_seconds,
+                "max_flush_seconds": self.max_flush_seconds,
+                "avg_flush_seconds": self.total_flush_seconds / self.batches if self.batches else 0.0,
+            }
+
+
+interaction_logger = None
+
+
+def start_interaction_logger(db_path=DB_PATH, batch_size=50, flush_interval=1.0):
+    global interaction_logger
+    if interaction_logger is None:
+        interaction_logger = InteractionLogger(db_path, batch_size, flush_interval)
+        atexit.register(interaction_logger.close)
+    return interaction_logger
+
+
+def record_interaction_in_database(user_id,
+                                   session_type,
+                                   channel_id=None,
+                                   thread_ts=None,
+                                   model_name=None,
+                                   embedding_name=None,
                                    user_question=None,
                                    user_question_ts=None,
-                                   bot_response=None, 
-                                   bot_response_ts=None, 
+                                   bot_response=None,
+                                   bot_response_ts=None,
                                    user_reaction=None,
-                                   user_reaction_ts=None, 
+                                   user_reaction_ts=None,
                                    formatted_sources=None,
-                                   history=None):
-    conn = sqlite3.connect('slackbot.db')
-    c = conn.cursor()
-
-    c.execute('''
-        INSERT INTO interactions (user_id, session_type, model_name, embedding_name, user_question, user_question_ts, bot_response, bot_response_ts, user_reaction, user_reaction_ts, formatted_sources, history)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, session_type, model_name, embedding_name, user_question, user_question_ts, bot_response, bot_response_ts, user_reaction, user_reaction_ts, formatted_sources, history))
+                                   history_length=0):
+    if session_type == 'reaction':
+        row = dict(session_type=session_type, user_id=user_id, channel_id=channel_id, bot_response_ts=bot_response_ts,
+                   user_reaction=user_reaction, user_reaction_ts=user_reaction_ts)
+    else:
+        row = dict(session_type=session_type, user_id=user_id, channel_id=channel_id, thread_ts=thread_ts,
+                   model_name=model_name, embedding_name=embedding_name, user_question=user_question,
+                   user_question_ts=user_question_ts, bot_response=bot_response, bot_response_ts=bot_response_ts,
+                   formatted_sources=formatted_sources, history_length=history_length)
+    if interaction_logger is not None:
+        # non-blocking, the background writer batches the insert
+        interaction_logger.record(row)
+        return
 
-    conn.commit()  
-    conn.close()  
+    conn = sqlite3.connect(DB_PATH)
+    write_interactions(conn, [row])
+    conn.close()
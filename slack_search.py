@@ -0,0 +1,158 @@
+import time
+import logging
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait
+from slack_sdk.web import WebClient
+from slack_sdk.errors import SlackApiError
+from utils import extract_keywords
+
+''' concurrent slack message search across channels for safety mode context '''
+
+logger = logging.getLogger(__name__)
+
+
+class SlackSearch:
+    """
+    Search several channels at once and merge the matches.
+
+    Each channel is queried on a bounded pool and the whole search gives up after timeout
+    seconds; channels that fail, time out or stay rate limited are skipped instead of failing
+    the mention. Searches use their own client whose HTTP timeout is also timeout, so a call
+    the search gave up on ends soon after and frees its pool thread for later mentions. Rate
+    limited calls are retried after Slack's Retry-After if that still fits in the timeout.
+    Matches are deduplicated by permalink and ranked by the number of keywords they contain,
+    then by recency. Results are cached per (keyword query, channel) for cache_ttl seconds.
+    """
+    def __init__(self, slack_user_client, max_workers=4, timeout=5, cache_ttl=60, count=5, max_cache_entries=1000):
+        # same token and endpoint as the user client, but calls don't outlive the search
+        self.slack_user_client = WebClient(token=slack_user_client.token, base_url=slack_user_client.base_url,
+                                           timeout=timeout)
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.count = count
+        self.max_cache_entries = max_cache_entries
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="slack-search")
+        self._cache = {}
+        self._lock = Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.failures = 0
+        self.rate_limited = 0
+
+    def search(self, query, channels):
+        keyword_query = extract_keywords(query)
+        if not keyword_query:
+            return []
+        deadline = time.monotonic() + self.timeout
+        results = {}
+        futures = {}
+        for channel in channels:
+            cached = self._cache_get(keyword_query, channel)
+            if cached is not None:
+                results[channel] = cached
+            else:
+                futures[self._executor.submit(self._search_channel, keyword_query, channel, deadline)] = channel
+        done, not_done = wait(futures, timeout=self.timeout)
+        for future in not_done:
+            logger.warning(f"Slack search in {futures[future]} timed out")
+            future.cancel()
+        for future in done:
+            channel = futures[future]
+            try:
+                matches = future.result()
+            except Exception:
+                logger.exception(f"Slack search in {channel} failed")
+                with self._lock:
+                    self.failures += 1
+                continue
+            self._cache_put(keyword_query, channel, matches)
+            results[channel] = matches
+        return self._merge(keyword_query, [results[channel] for channel in channels if channel in results])
+
+    def _search_channel(self, keyword_query, channel, deadline):
+        channel_query = f'{keyword_query} in:{channel}'
+        while True:
+            try:
+                response = self.slack_user_client.search_messages(query=channel_query,
+                                                                  sort='timestamp',
+                                                                  sort_dir='desc',
+                                                                  count=self.count)
+                break
+            except SlackApiError as e:
+                if e.response.get("error") != "ratelimited":
+                    raise
+                with self._lock:
+                    self.rate_limited += 1
+                retry_after = int(e.response.headers.get("Retry-After", 1))
+                if time.monotonic() + retry_after >= deadline:
+                    raise
+                time.sleep(retry_after)
+        return [{
+            "channel_id": match["channel"]["id"],
+            "channel_name": match["channel"]["name"],
+            "permalink": match["permalink"],
+            "text": match["text"],
+            "ts": match["ts"],
+            "type": match["type"]
+        } for match in response["messages"]["matches"]]
+
+    def _merge(self, keyword_query, channel_results):
+        keywords = keyword_query.split()
+        merged = {}
+        for matches in channel_results:
+            for match in matches:
+                merged.setdefault(match["permalink"], match)
+        def rank(match):
+            text = match["text"].lower()
+            return (sum(keyword in text for keyword in keywords), float(match["ts"]))
+        return sorted(merged.values(), key=rank, reverse=True)
+
+    def _cache_get(self, keyword_query, channel):
+        with self._lock:
+            entry = self._cache.get((keyword_query, channel))
+            if entry is not None and entry[0] > time.monotonic():
+                self.cache_hits += 1
+                return entry[1]
+            self.cache_misses += 1
+            return None
+
+    def _cache_put(self, keyword_query, channel, matches):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._cache) >= self.max_cache_entries:
+                self._cache = {key: entry for key, entry in self._cache.items() if entry[0] > now}
+                if len(self._cache) >= self.max_cache_entries:
+                    del self._cache[min(self._cache, key=lambda key: self._cache[key][0])]
+            self._cache[(keyword_query, channel)] = (now + self.cache_ttl, matches)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cache_entries": len(self._cache),
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "failures": self.failures,
+                "rate_limited": self.rate_limited,
+            }
+
+
+_slack_search = None
+_slack_search_lock = Lock()
+
+
+def get_slack_search(slack_user_client, config=None):
+    global _slack_search
+    with _slack_search_lock:
+        if _slack_search is None:
+            search_config = (config or {}).get('slack_search') or {}
+            _slack_search = SlackSearch(slack_user_client,
+                                        max_workers=search_config.get('max_workers', 4),
+                                        timeout=search_config.get('timeout', 5),
+                                        cache_ttl=search_config.get('cache_ttl', 60),
+                                        count=search_config.get('count', 5))
+    return _slack_search
+
+
+def slack_search_stats():
+    """ Stats of the shared SlackSearch, empty until the first search. """
+    return _slack_search.stats() if _slack_search is not None else {}
@@ -0,0 +1,95 @@
+import time
+import logging
+from threading import Lock
+from slack_sdk.errors import SlackApiError
+from langchain.callbacks.base import BaseCallbackHandler
+
+''' stream llm tokens into a slack message with rate limited chat_update calls '''
+
+logger = logging.getLogger(__name__)
+
+
+class SlackStreamingHandler(BaseCallbackHandler):
+    """
+    Post a placeholder reply and edit it as the answer streams in.
+
+    Tokens are collected from on_llm_new_token and the message is edited at most once
+    every interval_ms milliseconds, so long answers stay within Slack's chat.update rate
+    limit. If Slack still answers ratelimited, edits pause for the Retry-After it sends.
+    finish() writes the complete response, sources included, in one last edit.
+
+    Only models created with streaming=True emit tokens, so the question condensing step
+    of the chain, which uses a non-streaming copy of the model, never shows up here.
+    """
+    def __init__(self, slack_client, channel, thread_ts, interval_ms=1000, placeholder="_Thinking..._"):
+        self.slack_client = slack_client
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.interval = interval_ms / 1000
+        self.placeholder = placeholder
+        self.ts = None
+        self.tokens = []
+        self.updates = 0
+        self._lock = Lock()
+        self._next_update = 0.0
+        self._posted_at = None
+        self.first_token_seconds = None
+
+    def start(self):
+        response = self.slack_client.chat_postMessage(channel=self.channel, text=self.placeholder,
+                                                      thread_ts=self.thread_ts)
+        self.ts = response['ts']
+        self._posted_at = time.monotonic()
+        self._next_update = self._posted_at + self.interval
+        return response
+
+    def on_llm_new_token(self, token, **kwargs):
+        with self._lock:
+            if not self.tokens:
+                self.first_token_seconds = time.monotonic() - self._posted_at
+            self.tokens.append(token)
+            now = time.monotonic()
+            if now < self._next_update:
+                return
+            self._update("".join(self.tokens) + " ...", now)
+
+    def finish(self, text):
+        """
+        Replace the streamed text with the final response.
+
+        Returns:
+            (dict): A chat_postMessage-like response whose 'ts' is the streamed message.
+        """
+        with self._lock:
+            # the final edit goes out regardless of the interval, Slack queues it behind the others
+            self._next_update = 0.0
+            self._update(text, time.monotonic(), retry=True)
+        return {"ok": True, "channel": self.channel, "ts": self.ts}
+
+    def fail(self, text):
+        """
+        Replace the placeholder, and whatever streamed so far, with an error message when the
+        answer can't be finished. Slack errors are logged, the caller is already handling one.
+        """
+        if self.ts is None:
+            return
+        with self._lock:
+            try:
+                self._update(text, time.monotonic(), retry=True)
+            except SlackApiError:
+                logger.exception("Could not replace the placeholder with the error message")
+
+    def _update(self, text, now, retry=False):
+        try:
+            self.slack_client.chat_update(channel=self.channel, ts=self.ts, text=text)
+            self.updates += 1
+            self._next_update = now + self.interval
+        except SlackApiError as e:
+            if e.response.get("error") != "ratelimited":
+                raise
+            retry_after = int(e.response.headers.get("Retry-After", 1))
+            logger.warning(f"chat_update rate limited, retrying after {retry_after}s")
+            self._next_update = now + retry_after
+            if retry:
+                time.sleep(retry_after)
+                self._update(text, time.monotonic())
@@ -0,0 +1,101 @@
+import json
+import time
+import logging
+from threading import local
+from contextlib import contextmanager
+from metrics import registry
+
+''' per request stage timings for the mention pipeline '''
+
+logger = logging.getLogger('trace')
+
+stage_seconds = registry.histogram('stage_seconds', 'Time spent in each stage of a mention, by model and embedding')
+requests_total = registry.counter('requests_total', 'Mentions handled, by model, embedding and status')
+tokens_total = registry.counter('tokens_total', 'LLM tokens used, by model and kind')
+answer_cache_total = registry.counter('answer_cache_lookups_total', 'Answer cache lookups, by result')
+
+_current = local()
+
+
+class Trace:
+    """
+    Stage timings, token counts and flags of one request.
+
+    finish() records every stage in the stage_seconds histogram labelled by model and
+    embedding, and writes the whole trace as one JSON line to the "trace" logger.
+    """
+    def __init__(self, request_id, **labels):
+        self.request_id = request_id
+        self.labels = {"model": "unknown", "embedding": "unknown"}
+        self.labels.update(labels)
+        self.stages = {}
+        self.attrs = {}
+        self.start = time.perf_counter()
+        self.status = "ok"
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+    def incr(self, key, amount=1):
+        self.attrs[key] = self.attrs.get(key, 0) + amount
+
+    def finish(self, log=True):
+        self.add_stage("total", time.perf_counter() - self.start)
+        labels = {"model": self.labels["model"], "embedding": self.labels["embedding"]}
+        for name, seconds in self.stages.items():
+            stage_seconds.observe(seconds, stage=name, **labels)
+        requests_total.inc(status=self.status, **labels)
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if kind in self.attrs:
+                tokens_total.inc(self.attrs[kind], model=labels["model"], kind=kind)
+        if "answer_cache_hit" in self.attrs:
+            answer_cache_total.inc(result="hit" if self.attrs["answer_cache_hit"] else "miss")
+        if log:
+            logger.info(json.dumps({"request_id": self.request_id, "status": self.status, **self.labels,
+                                    "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+                                    **self.attrs}, default=str))
+        if getattr(_current, "trace", None) is self:
+            _current.trace = None
+
+
+class _NullTrace:
+    """ Stand-in when no request is being traced, so instrumented code never has to check. """
+    request_id = None
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add_stage(self, name, seconds):
+        pass
+
+    def set(self, key, value):
+        pass
+
+    def incr(self, key, amount=1):
+        pass
+
+
+_null_trace = _NullTrace()
+
+
+def start_trace(request_id, **labels):
+    trace = Trace(request_id, **labels)
+    _current.trace = trace
+    return trace
+
+
+def current_trace():
+    """ The trace of the request running on this thread, or a no-op trace. """
+    return getattr(_current, "trace", None) or _null_trace
@@ -0,0 +1,53 @@
+import time
+from langchain.callbacks.base import BaseCallbackHandler
+
+''' langchain callback timing the steps inside the chain, kept apart from tracing so startup doesn't import langchain '''
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Time the steps inside the chain: question condensation, retrieval and the answering LLM call.
+
+    With a chat history the chain first asks the LLM for a standalone question, so the first
+    LLM call of such a request is counted as question_condensation and the rest as llm.
+    Token usage reported by the LLM is added to the trace.
+    """
+    def __init__(self, trace, has_history):
+        self.trace = trace
+        self.has_history = has_history
+        self._llm_calls = 0
+        self._started = {}
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        stage = "question_condensation" if self.has_history and self._llm_calls == 0 else "llm"
+        self._llm_calls += 1
+        self._started[kwargs.get("run_id")] = (stage, time.perf_counter())
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.on_llm_start(serialized, messages, **kwargs)
+
+    def on_llm_end(self, response, **kwargs):
+        self._end(kwargs.get("run_id"))
+        token_usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+        for kind in ("prompt_tokens", "completion_tokens"):
+            if kind in token_usage:
+                self.trace.incr(kind, token_usage[kind])
+
+    def on_llm_error(self, error, **kwargs):
+        self._end(kwargs.get("run_id"))
+
+    def on_retriever_start(self, serialized, query, **kwargs):
+        self._started[kwargs.get("run_id")] = ("retrieval", time.perf_counter())
+
+    def on_retriever_end(self, documents, **kwargs):
+        self._end(kwargs.get("run_id"))
+        self.trace.set("retrieved_documents", len(documents))
+
+    def on_retriever_error(self, error, **kwargs):
+        self._end(kwargs.get("run_id"))
+
+    def _end(self, run_id):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            stage, start = started
+            self.trace.add_stage(stage, time.perf_counter() - start)
@@ -1,5 +1,5 @@
-from nltk.tokenize import word_tokenize
-from constants import important_keywords
+from constants import important_keywords, TOKEN_LIMIT
+from tracing import current_trace
 import re
 
 def parse_model_and_embedding(user_message, say, ts, available_models, available_embeddings):
@@ -21,7 +21,7 @@ def parse_model_and_embedding(user_message, say, ts, available_models, available
     return model_name, embedding_name
 
 
-def get_model_and_embedding(safety_mode, user_message, say, ts):
+def get_model_and_embedding(safety_mode, user_message, say, ts, available_models, available_embeddings):
     """
     return the model and embbedding based on safety mode and user message
 
@@ -30,13 +30,15 @@ def get_model_and_embedding(safety_mode, user_message, say, ts):
         user_message (str): The user's message.
         say (callable): A function for sending a response to the channel.
         ts (str): The timestamp of the user's message.
+        available_models (list): The model names in config.yaml.
+        available_embeddings (list): The embedding names in config.yaml.
     Returns:
         (str, str): The model and embedding names.
     """
     if safety_mode:
         return "<intentionally left blank>", "hf-sentence-transformer"
     else:
-        return parse_model_and_embedding(user_message, say, ts)
+        return parse_model_and_embedding(user_message, say, ts, available_models, available_embeddings)
     
 
 def clean_user_message(user_message):
@@ -58,14 +60,43 @@ def get_lazy_model_and_embedding(model_name, embedding_name, models, embeddings)
     lazy_embedding = embeddings.get(embedding_name)
     return lazy_model, lazy_embedding
 
-def get_response_and_history(qa, user_message, history, tokenizer):
-    response = qa({"question": user_message, "chat_history": history})
+def get_response_and_history(qa, user_message, history, lazy_model, answer_cache=None, lazy_embedding=None, cache_namespace=None, callbacks=None):
+    """
+    Ask the chain and add the new turn to the thread history.
+
+    The first question of a thread is already standalone, so it is looked up in the
+    answer cache (if given) before calling the chain, and stored there on a miss.
+    Follow-up questions depend on the history and always go through the chain.
+
+    Args:
+        qa (ConversationalRetrievalChain): The chain answering the question.
+        user_message (str): The cleaned user message.
+        history (ThreadHistory): The history of the thread, updated in place.
+        lazy_model (LazyModel): The model answering, provides the tokenizer and token limit.
+        answer_cache (SemanticAnswerCache): Optional cache of answers to earlier questions.
+        lazy_embedding (LazyEmbedding): The embedding of the chat, used to embed the question for the cache.
+        cache_namespace (tuple): The (model name, embedding name, safety mode) the answer is cached under.
+        callbacks (list): Optional callback handlers for this call, e.g. a SlackStreamingHandler.
+    Returns:
+        (dict, str, ThreadHistory): The chain response, the answer and the updated history.
+    """
+    trace = current_trace()
+    use_cache = answer_cache is not None and len(history) == 0
+    response = None
+    if use_cache:
+        with trace.stage("answer_cache"):
+            question_vector = answer_cache.embed(lazy_embedding, user_message)
+            response = answer_cache.lookup(cache_namespace, question_vector)
+        trace.set("answer_cache_hit", response is not None)
+    if response is None:
+        with trace.stage("chain"):
+            response = qa({"question": user_message, "chat_history": history.as_chat_history()}, callbacks=callbacks)
+        if use_cache:
+            answer_cache.store(cache_namespace, question_vector, user_message, response)
     answer = response['answer']
-    new_history_item = (user_message, response["answer"])
-    new_history_item_tokens = len(tokenizer.encode(' '.join(new_history_item)))
-    while len(history) > 0 and sum(len(tokenizer.encode(' '.join(item))) for item in history) + new_history_item_tokens > TOKEN_LIMIT:
-        history.pop(0)
-    history.append(new_history_item)
+    token_count = len(lazy_model.tokenizer.encode(f"{user_message} {answer}"))
+    trace.set("turn_tokens", token_count)
+    history.append(user_message, answer, token_count, lazy_model.config.get('token_limit', TOKEN_LIMIT))
     return response, answer, history
 
 def format_response(response, answer):
@@ -82,6 +113,8 @@ def extract_keywords(query):
     """
     extract keywords from the query
     """
+    # nltk is only needed by safety mode's slack search, import it (and its punkt data) on first use
+    from nltk.tokenize import word_tokenize
     word_tokens = word_tokenize(query.lower())
     # Filter out only important keywords
     filtered_words = [w for w in word_tokens if w in important_keywords]
@@ -0,0 +1,101 @@
+import time
+import logging
+from threading import Thread, Lock
+from index_registry import get_index_registry, get_vb_config, touch_index_pages
+from utils import extract_keywords
+from answer_cache import get_answer_cache
+
+''' background warm-up of indexes, models and everything else kept off the startup path '''
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """
+    Pre-load the configured indexes and embedding models, the models' tokenizers and nltk's
+    data, and seed the answer cache, in a background thread so the first mention doesn't pay
+    for them. tasks are run
+    first, e.g. the auth.test call startup no longer makes. Status is one of "pending",
+    "running", "ready" or "failed"; individual failures are logged and kept in errors.
+    """
+    def __init__(self, config, embeddings, models=None, tasks=None):
+        self.config = config
+        self.embeddings = embeddings
+        self.models = models or {}
+        self.tasks = tasks or {}
+        self.status = "pending"
+        self.errors = {}
+        self.seconds = None
+        self._lock = Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.status = "running"
+            self._thread = Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        start = time.perf_counter()
+        for name, task in self.tasks.items():
+            self._try(name, task)
+        for name, lazy_model in self.models.items():
+            self._try(f"tokenizer of {name}", lambda: lazy_model.tokenizer)
+        try:
+            extract_keywords("warm-up")
+        except LookupError as e:
+            # only safety mode's slack search needs it, so it doesn't fail the warm-up
+            logger.warning(f"nltk data is missing, safety mode search won't work until it is downloaded: {e}")
+        vb_names = {vb['vb_name'] for vb in self.config.get('vectordb', [])}
+        warmup_config = self.config.get('warmup') or {}
+        names = warmup_config.get('embeddings') or list(self.embeddings)
+        for name in names:
+            lazy_embedding = self.embeddings.get(name)
+            if lazy_embedding is None or lazy_embedding.config.get('vb_name') not in vb_names:
+                continue
+            self._try(name, lambda: self._warm(lazy_embedding))
+            self._try(f"answer cache seeding of {name}", lambda: self._seed_answer_cache(name, lazy_embedding))
+        self.seconds = time.perf_counter() - start
+        self.status = "failed" if self.errors else "ready"
+        logger.info(f"Warm-up {self.status} in {self.seconds:.2f}s")
+
+    def _try(self, name, task):
+        try:
+            task()
+        except Exception as e:
+            logger.exception(f"Warm-up failed for {name}")
+            self.errors[name] = str(e)
+
+    def _warm(self, lazy_embedding):
+        embedding = lazy_embedding.embedding
+        if lazy_embedding.config['type'] != 'OpenAIEmbeddings':
+            # run one forward pass so local models are fully initialized (skipped for paid APIs)
+            embedding.embed_query("warm-up")
+        vb_config = get_vb_config(self.config, lazy_embedding.config['vb_name'])
+        get_index_registry(self.config).get(lazy_embedding, self.config)
+        if vb_config.get('load_mode') == 'mmap':
+            touch_index_pages(vb_config['path'])
+
+    def _seed_answer_cache(self, name, lazy_embedding):
+        answer_cache = get_answer_cache(self.config)
+        if answer_cache is None:
+            return
+        namespaces = [(model_name, name, safety_mode) for model_name in self.models for safety_mode in (False, True)]
+        answer_cache.seed(namespaces, lazy_embedding)
+
+    def is_ready(self):
+        return self.status == "ready"
+
+    def health(self):
+        return {"status": self.status, "seconds": self.seconds, "errors": self.errors}
+
+
+def start_warmup(config, embeddings, models=None, tasks=None):
+    warmup = Warmup(config, embeddings, models, tasks)
+    if (config.get('warmup') or {}).get('enabled', False):
+        warmup.start()
+    else:
+        warmup.status = "ready"
+    return warmup